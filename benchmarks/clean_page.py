@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the error page normaliser, _clean_page().
+
+The current implementation is compared with the original one, which
+ran each substitution as a separate pass. Before timing, both are run
+on the sample pages and on random input to check that they produce
+the same digests.
+
+Usage: python3 benchmarks/clean_page.py [number of runs]
+"""
+
+import hashlib
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wig.classes.request2 import _clean_page
+
+
+def legacy_clean_page(page):
+	page = re.sub(b'(\\d?\\d:?){2,3}', b'',page)
+	page = re.sub(b'AM', b'',page, flags=re.IGNORECASE)
+	page = re.sub(b'PM', b'',page, flags=re.IGNORECASE)
+	page = re.sub(b'(\\d){13}', b'', page)
+
+	page = re.sub(b'(\\d){8}', b'',page)
+	page = re.sub(b'\\d{4}-\\d{2}-\\d{2}', b'',page)
+	page = re.sub(b'\\d{4}/\\d{2}/\\d{2}', b'',page)
+	page = re.sub(b'\\d{2}-\\d{2}-\\d{4}', b'',page)
+	page = re.sub(b'\\d{2}/\\d{2}/\\d{4}', b'',page)
+
+	page = re.sub( b'(\\d){6}', b'',page)
+	page = re.sub( b'\\d{2}-\\d{2}-\\d{2}', b'',page)
+	page = re.sub( b'\\d{2}/\\d{2}/\\d{2}', b'',page)
+
+	page = re.sub( b'/[^ ]+',  b'', page)
+	page = re.sub( b'[a-zA-Z]:\\[^ ]+',  b'', page)
+
+	return hashlib.md5(page).hexdigest().lower()
+
+
+def get_samples():
+	error_page = (
+		b'<html><head><title>404 Not Found</title></head><body>'
+		b'<h1>Not Found</h1><p>The requested URL /random98f092f0b7.html was not found '
+		b'on this server.</p><hr><address>Apache/2.4.7 (Ubuntu) Server at example.com '
+		b'Port 80</address><p>Generated 2016-03-14 10:21:07 PM, request 1457950867123</p>'
+		b'</body></html>'
+	)
+
+	# a page with a lot of text and links
+	page = b' '.join([
+		b'<p>Posted on 14/03/2016 at 10:21 AM by <a href="/author/admin/">admin</a></p>',
+		b'<script src="/wp-includes/js/jquery/jquery.js?ver=1.11.3"></script>',
+		b'<div class="entry">Lorem ipsum dolor sit amet, consectetur adipiscing elit.</div>',
+	] * 200)
+
+	# binary data, e.g. an image
+	rnd = random.Random(0)
+	image = bytes(rnd.getrandbits(8) for _ in range(64 * 1024))
+
+	return {'error page': error_page, 'page': page, 'image': image}
+
+
+def get_random_input(rnd, length):
+	alphabet = b'0123456789:/-\\[^] aAmMpPxC'
+	return bytes(rnd.choice(alphabet) for _ in range(length))
+
+
+def check(samples):
+	rnd = random.Random(1)
+	pages = list(samples.values()) + [get_random_input(rnd, rnd.randint(0, 64)) for _ in range(20000)]
+
+	for page in pages:
+		if _clean_page(page) != legacy_clean_page(page):
+			print('Digest mismatch for: %r' % (page[:100], ))
+			sys.exit(1)
+
+	print('Digests match for %s pages' % (len(pages), ))
+
+
+def main():
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	samples = get_samples()
+	check(samples)
+
+	print('%-12s %12s %12s %8s' % ('sample', 'legacy (ms)', 'current (ms)', 'speedup'))
+	for name, page in samples.items():
+		legacy = min(timeit.repeat(lambda: legacy_clean_page(page), number=runs, repeat=3)) / runs
+		current = min(timeit.repeat(lambda: _clean_page(page), number=runs, repeat=3)) / runs
+		print('%-12s %12.3f %12.3f %7.1fx' % (name, legacy * 1000, current * 1000, legacy / current))
+
+
+if __name__ == '__main__':
+	main()
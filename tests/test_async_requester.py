@@ -0,0 +1,125 @@
+"""
+Tests of the async request engine against a local http.server.
+
+Run with: python3 -m unittest discover tests
+"""
+
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wig.wig import wig
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	# keep-alive connections, so a handler serves a whole connection
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		super().setup()
+		with self.server.lock:
+			self.server.connections += 1
+			self.server.max_connections = max(self.server.max_connections, self.server.connections)
+
+	def finish(self):
+		super().finish()
+		with self.server.lock:
+			self.server.connections -= 1
+
+	def log_message(self, *args):
+		pass
+
+	def _respond(self, send_body):
+		if self.path.startswith('/found'):
+			code, body = 200, ('page %s' % (self.path, )).encode()
+		else:
+			code, body = 404, b'not found'
+
+		self.send_response(code)
+		self.send_header('Content-Type', 'text/html')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+
+		if send_body:
+			self.wfile.write(body)
+
+	def do_GET(self):
+		self._respond(True)
+
+	def do_HEAD(self):
+		self._respond(False)
+
+
+class TestAsyncRequester(unittest.TestCase):
+
+	def setUp(self):
+		# the stock server, which only queues a few connections
+		self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.server.daemon_threads = True
+		self.server.lock = threading.Lock()
+		self.server.connections = 0
+		self.server.max_connections = 0
+
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.addCleanup(self.server.server_close)
+		self.addCleanup(self.server.shutdown)
+
+		self.url = 'http://127.0.0.1:%s' % (self.server.server_address[1], )
+
+		cache_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(cache_dir.cleanup)
+		self.cache_dir = cache_dir.name
+
+	def create_requester(self, **options):
+		# the command line of the test runner is not for wig
+		with mock.patch.object(sys, 'argv', ['wig']):
+			w = wig(url=self.url, engine='async', no_cache_load=True, no_cache_save=True, cache_dir=self.cache_dir, **options)
+
+		w.data['cache'].set_host(self.url)
+		requester = w.create_requester()
+		self.addCleanup(requester.close)
+
+		return requester
+
+	def request(self, requester, urls):
+		fp_lists = [[{'url': url, 'type': 'string', 'match': 'page'}] for url in urls]
+		return {fps[0]['url']: response for fps, response in requester.stream('Test', fp_lists)}
+
+	def test_responses(self):
+		requester = self.create_requester()
+		found = ['/found_%s' % (i, ) for i in range(20)]
+		missing = ['/missing_%s' % (i, ) for i in range(20)]
+
+		responses = self.request(requester, found + missing)
+
+		for url in found:
+			self.assertEqual(responses[url].status['code'], 200)
+			self.assertEqual(responses[url].body, 'page %s' % (url, ))
+
+		for url in missing:
+			self.assertIsNone(responses[url])
+
+	def test_host_connections(self):
+		requester = self.create_requester(concurrency=100, host_connections=4)
+		urls = ['/found_%s' % (i, ) for i in range(100)]
+
+		responses = self.request(requester, urls)
+
+		self.assertTrue(all(responses[url] is not None for url in urls))
+		self.assertLessEqual(self.server.max_connections, 4)
+
+	def test_keep_alive(self):
+		requester = self.create_requester(host_connections=2)
+		self.request(requester, ['/found_%s' % (i, ) for i in range(20)])
+
+		self.assertGreater(requester.pool.get_stats()['hits'], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
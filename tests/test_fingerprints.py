@@ -0,0 +1,51 @@
+"""
+Tests of the detection of a stale fingerprint database.
+
+Run with: python3 -m unittest discover tests
+"""
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wig.classes.fingerprints import Fingerprints
+
+
+class TestDatabase(unittest.TestCase):
+
+	def setUp(self):
+		# compile a database for a copy of the fingerprints
+		temp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(temp_dir.cleanup)
+
+		self.data_dir = os.path.join(temp_dir.name, 'data')
+		shutil.copytree(Fingerprints().datadir, self.data_dir, ignore=shutil.ignore_patterns('*.db'))
+		Fingerprints(data_dir=self.data_dir).compile_database()
+
+	def is_up_to_date(self):
+		return Fingerprints(data_dir=self.data_dir)._check_database()
+
+	def test_up_to_date(self):
+		self.assertTrue(self.is_up_to_date())
+
+	def test_modified_in_subdirectory(self):
+		file_name = sorted(glob.glob(os.path.join(self.data_dir, 'cms', 'md5', '*.json')))[0]
+		stat = os.stat(file_name)
+		os.utime(file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+		self.assertFalse(self.is_up_to_date())
+
+	def test_added(self):
+		with open(os.path.join(self.data_dir, 'cms', 'md5', 'new.json'), 'w') as fh:
+			fh.write('[]')
+
+		self.assertFalse(self.is_up_to_date())
+
+
+if __name__ == '__main__':
+	unittest.main()
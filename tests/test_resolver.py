@@ -0,0 +1,51 @@
+"""
+Tests of the caching of DNS lookups.
+
+Run with: python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wig.classes.resolver import Resolver
+
+
+class FakeResolver(Resolver):
+	# looks up names without the network
+
+	def _lookup(self, name):
+		return ['127.0.0.1'], self.ttl
+
+
+class TestResolver(unittest.TestCase):
+
+	def test_cached(self):
+		resolver = FakeResolver()
+		resolver.resolve('example.com')
+		resolver.resolve('example.com')
+
+		self.assertEqual(resolver.get_stats(), {'hits': 1, 'misses': 1})
+		self.assertEqual(resolver.name_locks, {})
+
+	def test_expired(self):
+		resolver = FakeResolver(ttl=0)
+		resolver.resolve('example.com')
+		time.sleep(0.01)
+
+		self.assertIsNone(resolver._get_cached('example.com'))
+		self.assertNotIn('example.com', resolver.cache)
+
+	def test_max_size(self):
+		resolver = FakeResolver(max_size=3)
+		for i in range(10):
+			resolver.resolve('%s.example.com' % (i, ))
+
+		self.assertEqual(list(resolver.cache), ['7.example.com', '8.example.com', '9.example.com'])
+
+
+if __name__ == '__main__':
+	unittest.main()
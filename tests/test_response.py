@@ -0,0 +1,74 @@
+"""
+Tests of the decoding of response bodies.
+
+Run with: python3 -m unittest discover tests
+"""
+
+import hashlib
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wig.classes.cache import Cache
+from wig.classes.request2 import Response
+
+
+def create_response(raw, content_type=None):
+	response = Response()
+	response.raw = raw
+	response.headers = {} if content_type is None else {'content-type': content_type}
+	response.md5 = hashlib.md5(raw).hexdigest()
+	return response
+
+
+class TestResponseBody(unittest.TestCase):
+
+	def test_charset(self):
+		response = create_response('caf\xe9'.encode('iso-8859-1'), 'text/html; charset="ISO-8859-1"')
+		self.assertEqual(response.body, 'caf\xe9')
+
+	def test_default_is_utf8(self):
+		for content_type in [None, 'text/html', 'application/javascript']:
+			response = create_response('caf\xe9'.encode('utf-8'), content_type)
+			self.assertEqual(response.body, 'caf\xe9')
+
+	def test_bogus_charset(self):
+		content_types = [
+			'text/html; charset=foo',
+			'text/html; charset=',
+			'text/html;charset=utf-8;charset',
+			'text/html; charset=rot13',
+		]
+
+		for content_type in content_types:
+			response = create_response(b'<title>caf\xc3\xa9</title>\xff', content_type)
+			self.assertEqual(response.body, '<title>caf\xe9</title>�')
+
+	def test_shared_per_md5(self):
+		cache = Cache()
+		first = create_response(b'<p>not found</p>', 'text/html')
+		second = create_response(b'<p>not found</p>', 'text/html')
+		cache['/a'] = first
+		cache['/b'] = second
+
+		self.assertIs(first.raw, second.raw)
+		self.assertIs(first.body, second.body)
+		self.assertEqual(second.md5_404_text, first.md5_404_text)
+		self.assertIs(first._derived, second._derived)
+
+	def test_shared_charsets(self):
+		cache = Cache()
+		first = create_response('caf\xe9'.encode('iso-8859-1'), 'text/html; charset=iso-8859-1')
+		second = create_response('caf\xe9'.encode('iso-8859-1'), 'text/html')
+		cache['/a'] = first
+		cache['/b'] = second
+
+		# the same body is decoded according to each response's charset
+		self.assertEqual(first.body, 'caf\xe9')
+		self.assertEqual(second.body, 'caf\ufffd')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
-from wig.wig import Wig, parse_args
+import sys
+from wig.wig import Wig, parse_args, build_database
 
 
 # if called from the command line
 if __name__ == '__main__':
 	args = parse_args()
 
+	if args.build_db:
+		build_database()
+		sys.exit(0)
+
 	try:
 		wig = Wig(args)
 		wig.run()
@@ -0,0 +1,2 @@
+# the version of wig, the same as in setup.py
+__version__ = '0.6'
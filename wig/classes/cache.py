@@ -1,8 +1,178 @@
 import queue
+import copy
 import pickle
+import sqlite3
+import threading
 import os, sys
 import time
 
+
+# bump this when the layout of the store changes
+STORE_VERSION = 3
+
+
+class ResponseStore(object):
+	"""
+	Persistent storage of responses, shared by all the hosts.
+
+	The responses are stored in a SQLite database indexed by (host, url),
+	which allows a single response to be loaded without loading all the
+	responses for the host. Each response has its own expiry time.
+	Expired responses are kept for a while, so they can be revalidated
+	instead of fetched again. After that they are evicted, and if the
+	store grows beyond its maximum size, the oldest responses are
+	evicted as well.
+
+	The bodies are stored separately, keyed by the md5 of the response,
+	so identical bodies, e.g. soft 404 pages, are only stored once.
+	"""
+
+	def __init__(self, file_name):
+		self.file_name = file_name
+		self.lock = threading.Lock()
+
+		# eviction goes through the whole store, so it is only done on
+		# the first save of a process, and then every 'evict_interval' saves
+		self.evict_interval = 100
+		self.num_saves = 0
+
+		# the store can be shared by multiple processes (see --workers)
+		self.db = sqlite3.connect(file_name, timeout=60, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+
+		# start over if the store was written by another version
+		if self.db.execute('PRAGMA user_version').fetchone()[0] != STORE_VERSION:
+			self.db.execute('DROP TABLE IF EXISTS responses')
+			self.db.execute('DROP TABLE IF EXISTS bodies')
+			self.db.execute('PRAGMA user_version = %s' % (STORE_VERSION, ))
+
+		self.db.execute('''
+			CREATE TABLE IF NOT EXISTS responses (
+				host TEXT, url TEXT, saved INTEGER, expires INTEGER, size INTEGER, data BLOB, body TEXT,
+				PRIMARY KEY (host, url)
+			)''')
+		self.db.execute('CREATE INDEX IF NOT EXISTS responses_saved ON responses (saved)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS responses_body ON responses (body)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS bodies (md5 TEXT PRIMARY KEY, size INTEGER, data BLOB)')
+		self.db.commit()
+
+	def get_urls(self, host, now, stale_ttl=0):
+		# returns the urls of the fresh and the stale responses
+		with self.lock:
+			rows = self.db.execute('SELECT url, expires FROM responses WHERE host = ? AND expires > ?', (host, now - stale_ttl))
+			fresh, stale = [], []
+			for url, expires in rows:
+				(fresh if expires > now else stale).append(url)
+
+			return fresh, stale
+
+	def get(self, host, url, bodies):
+		# 'bodies' holds the bodies that are already loaded, so
+		# each body is only loaded once
+		with self.lock:
+			row = self.db.execute('SELECT data, body FROM responses WHERE host = ? AND url = ?', (host, url)).fetchone()
+			if row is None:
+				return None
+
+			data, key = row
+			if key is not None and key not in bodies:
+				body = self.db.execute('SELECT data FROM bodies WHERE md5 = ?', (key, )).fetchone()
+				if body is None:
+					return None
+
+				bodies[key] = pickle.loads(body[0])
+
+		response = pickle.loads(data)
+		if key is not None:
+			response.raw = bodies[key]
+
+		return response
+
+	def put(self, host, responses, now, ttl):
+		rows, blobs = [], {}
+		for url, response in responses:
+			key = response.md5
+			if key is not None:
+				blobs[key] = response.raw
+				response = copy.copy(response)
+				response.raw = None
+
+			data = pickle.dumps(response)
+			rows.append((host, url, now, now + ttl, len(data), data, key))
+
+		bodies = []
+		for key, body in blobs.items():
+			data = pickle.dumps(body)
+			bodies.append((key, len(data), data))
+
+		with self.lock:
+			self.db.executemany('INSERT OR IGNORE INTO bodies VALUES (?, ?, ?)', bodies)
+			self.db.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+			self.db.commit()
+
+	def _get_size(self):
+		size = 0
+		for table in ['responses', 'bodies']:
+			size += self.db.execute('SELECT COALESCE(SUM(size), 0) FROM %s' % (table, )).fetchone()[0]
+
+		return size
+
+	def _get_cutoff(self, excess):
+		# returns the newest save time that has to be evicted to free
+		# 'excess' bytes. A body is freed along with the newest
+		# response that uses it
+		rows = self.db.execute('''
+			SELECT saved, SUM(size) FROM (
+				SELECT saved, size FROM responses
+				UNION ALL
+				SELECT MAX(responses.saved), bodies.size FROM bodies JOIN responses ON responses.body = bodies.md5 GROUP BY bodies.md5
+			) GROUP BY saved ORDER BY saved''')
+
+		cutoff = None
+		for saved, size in rows:
+			cutoff = saved
+			excess -= size
+			if excess <= 0:
+				break
+
+		return cutoff
+
+	def should_evict(self):
+		with self.lock:
+			self.num_saves += 1
+			return (self.num_saves - 1) % self.evict_interval == 0
+
+	def evict(self, now, max_size, stale_ttl=0):
+		with self.lock:
+			self.db.execute('DELETE FROM responses WHERE expires <= ?', (now - stale_ttl, ))
+			self.db.execute('DELETE FROM bodies WHERE md5 NOT IN (SELECT body FROM responses WHERE body IS NOT NULL)')
+
+			# remove the oldest responses until the store is small enough
+			size = self._get_size()
+			if size > max_size:
+				cutoff = self._get_cutoff(size - max_size)
+				if cutoff is not None:
+					self.db.execute('DELETE FROM responses WHERE saved <= ?', (cutoff, ))
+					self.db.execute('DELETE FROM bodies WHERE md5 NOT IN (SELECT body FROM responses WHERE body IS NOT NULL)')
+
+			self.db.commit()
+
+
+# the stores are shared by all caches using the same location. A
+# SQLite connection cannot be used across fork(), so each process
+# (see --workers) opens its own
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(file_name):
+	key = (os.getpid(), file_name)
+	with _stores_lock:
+		if key not in _stores:
+			_stores[key] = ResponseStore(file_name)
+
+		return _stores[key]
+
+
 class Cache(queue.Queue):
 	"""
 	wig uses a cache to store the requests and responses made during a scan.
@@ -15,28 +185,104 @@ class Cache(queue.Queue):
 	def _init(self, maxsize):
 		self.queue = dict()
 		self.host = None
-		self.now = str(time.time()).split('.')[0]
+		self.now = int(time.time())
 		self.printer = None
 
-		self.cache_name = ''
+		self.store = None
+
+		# urls of responses that are in the store, but not loaded yet
+		self.stored = set()
+
+		# urls of expired responses that are in the store. These
+		# are only used to revalidate the responses
+		self.stale = set()
+
+		# urls of the responses added during this scan
+		self.new_urls = set()
+
+		# the bodies of the responses, keyed by md5. Identical
+		# bodies are shared between the responses
+		self.bodies = {}
+
+		# the values derived from the bodies, i.e. the decoded
+		# bodies and the md5 sums used for error page detection,
+		# keyed by md5. These are shared in the same way
+		self.derived = {}
 
 		# only load cache data that is new than this
 		# (currently this is set for 24 hours)
 		self.cache_ttl = 60*60*24
 
+		# expired responses are kept for revalidation for a week
+		self.cache_stale_ttl = 60*60*24*7
+
+		# the maximum size of the store in bytes
+		self.cache_max_size = 1024*1024*1024
+
 
 	def __getitem__(self, path):
-		return self.queue[path]
+		with self.mutex:
+			if path not in self.queue and path in self.stored:
+				self.stored.discard(path)
+
+				# load the response from the store
+				try:
+					response = self.store.get(self.host, path, self.bodies)
+				except Exception:
+					response = None
+
+				if response is not None:
+					self._share_body(response)
+					self.queue[path] = response
+
+			return self.queue[path]
 
 
 	def __setitem__(self, path, response):
 		with self.mutex:
+			self._share_body(response)
 			self.queue[path] = response
+			self.stored.discard(path)
+			self.new_urls.add(path)
+
+
+	def get(self, path):
+		# returns the response for 'path', or None if it is not cached,
+		# or if it could not be loaded from the store, e.g. because it
+		# was evicted by another process
+		try:
+			return self[path]
+		except KeyError:
+			return None
+
+
+	def get_stale(self, path):
+		# returns the expired response for 'path', or None
+		with self.mutex:
+			if path not in self.stale:
+				return None
+
+			self.stale.discard(path)
+			try:
+				response = self.store.get(self.host, path, self.bodies)
+			except Exception:
+				return None
+
+			if response is not None:
+				self._share_body(response)
+
+			return response
 
 
 	def __contains__(self, url):
 		with self.mutex:
-			return url in self.queue
+			return url in self.queue or url in self.stored
+
+
+	def _share_body(self, response):
+		if response.md5 is not None:
+			response.raw = self.bodies.setdefault(response.md5, response.raw)
+			response._derived = self.derived.setdefault(response.md5, response._derived)
 
 
 	def _check_or_create_cache(self):
@@ -45,7 +291,8 @@ class Cache(queue.Queue):
 
 
 	def _remove_old_caches(self):
-		# remove caches that are too old
+		# remove cache files written by older versions of wig,
+		# once they are too old to have been used by them
 
 		# bail if the directory does not exist
 		if not os.path.exists(self.cache_dir):
@@ -58,38 +305,25 @@ class Cache(queue.Queue):
 			if not cache_file.endswith('.cache'):
 				continue
 
-			# check if the cache is for the host
-			_, time_ext = cache_file.split('_-_')
-			save_time, _ = time_ext.split('.')
+			# the name of the file holds the time it was saved
+			try:
+				_, time_ext = cache_file.split('_-_')
+				save_time, _ = time_ext.split('.')
+				age = int(self.now) - int(save_time)
+			except ValueError:
+				continue
 
-			# check the age of the cache, and remove it if older than
-			# ttl
-			age = int(self.now) - int(save_time)
 			if age > self.cache_ttl:
 				file_name = os.path.join(self.cache_dir, cache_file)
 				os.remove(file_name)
 
 
-	def _get_name_for_cache_file(self):
-		# check if there already is an older version of the cache
-		# if there is, return the name of this file.
-		# it will be overwritten
-		if not os.path.exists(self.cache_dir):
-			os.makedirs(self.cache_dir)
-
-		for cache_file in os.listdir(self.cache_dir):
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
-
-			# check if the cache is for the host
-			hostname, _ = cache_file.split('_-_')
-			if hostname == self.cache_name.split('_-_')[0]:
-				return os.path.join(self.cache_dir, cache_file)
-
-		# if there aren't any previous cache files, generate a
-		# new name for the cache
-		return os.path.join(self.cache_dir, self.cache_name)
+	def _load_all(self):
+		for path in list(self.stored):
+			try:
+				self.__getitem__(path)
+			except KeyError:
+				pass
 
 
 	def set_location(self, cache_dir):
@@ -106,88 +340,82 @@ class Cache(queue.Queue):
 			try:
 				if not os.path.exists(cache_dir):
 					os.makedirs(cache_dir)
-				
+
 				self.cache_dir = cache_dir
 			except:
 				# bail if something went wrong
 				print('Cache creation error. Permission error?')
 				sys.exit(1)
-		
+
 		# check if cache dir exists - create if not
 		self._check_or_create_cache()
 
-		# check if there are caches that are older than ttl
-		self._remove_old_caches()
-		
+		# the response store replaces the pickled cache files
+		# of older versions
+		store_name = os.path.abspath(os.path.join(self.cache_dir, 'responses.db'))
+		if (os.getpid(), store_name) not in _stores:
+			self._remove_old_caches()
+
+		self.store = get_store(store_name)
+
 
 	def set_host(self, host):
 		self.host = host
-		self.cache_name = self.host.replace('/', '').replace(':', '..') + '_-_' + self.now + '.cache'
 
 
 	def get_num_urls(self):
+		self._load_all()
 		return len(set([self.queue[key].id for key in self.queue]))
 
 
 	def get_urls(self):
-		return [k for k in self.queue]
+		with self.mutex:
+			return list(self.queue) + list(self.stored)
 
 
 	def get_responses(self):
-		return [self.queue[key] for key in self.queue]
+		self._load_all()
+		return [self.queue[key] for key in list(self.queue)]
 
 
 	def save(self):
-		# save the queue for later use
+		# save the responses of the scan for later use
 		# this will help limit the amount of requests made
 		# when scanning the same site multiple times
+		# truncated responses are not saved, as they are not
+		# the complete resources
 		with self.mutex:
-			file_name = self._get_name_for_cache_file()
-			with open(file_name, 'wb') as cache_file:
-				try:
-					pickle.dump(self.queue, cache_file)
-				except Exception as err:
-					if self.printer:
-						self.printer.print_debug_line('Error saving cache', 1)
-				else:
-					if self.printer:
-						self.printer.print_debug_line('Saved cache to: %s' % (file_name, ), 1)
-
+			responses = [(url, self.queue[url]) for url in self.new_urls if not self.queue[url].truncated]
+
+		try:
+			self.store.put(self.host, responses, self.now, self.cache_ttl)
+			if self.store.should_evict():
+				self.store.evict(self.now, self.cache_max_size, self.cache_stale_ttl)
+		except Exception as err:
+			if self.printer:
+				self.printer.print_debug_line('Error saving cache', 1)
+		else:
+			if self.printer:
+				self.printer.print_debug_line('Saved %s responses to: %s' % (len(responses), self.store.file_name), 1)
 
 
 	def load(self):
-		# loads previously saved cache for the host
+		# finds previously saved responses for the host
+		# the responses are loaded when they are used
 
 		# bail if the host is not set
 		if self.host is None:
 			return None
 
-		# search the cache dir
-		for cache_file in os.listdir(self.cache_dir):
-
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
-
-			# check if the cache is for the host
-			hostname, time_ext = cache_file.split('_-_')
-			save_time, _ = time_ext.split('.')
-
-			# calc the age of the cache
-			age = int(self.now) - int(save_time)
-
-			# overwrite the current queue if it's for the host and the cache is not too old
-			if hostname == self.cache_name.split('_-_')[0] and age < self.cache_ttl:
-				file_name = os.path.join(self.cache_dir, cache_file)
-				try:
-					with open(file_name, 'rb') as handle:
-						data = pickle.load(handle)
-						for path in data:
-							self.__setitem__(path, data[path])
-				except:
-					if self.printer:
-						self.printer.print_debug_line('Error loading cache', 1)
-				else:
-					if self.printer:
-						self.printer.print_debug_line('Loaded cache from: %s' % (cache_file, ), 1)
+		try:
+			urls, stale = self.store.get_urls(self.host, self.now, self.cache_stale_ttl)
+		except Exception:
+			if self.printer:
+				self.printer.print_debug_line('Error loading cache', 1)
+		else:
+			with self.mutex:
+				self.stored.update(url for url in urls if url not in self.queue)
+				self.stale.update(url for url in stale if url not in self.queue)
 
+			if self.printer:
+				self.printer.print_debug_line('Found %s cached responses in: %s' % (len(urls), self.store.file_name), 1)
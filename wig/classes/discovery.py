@@ -3,13 +3,22 @@ Collection of classes to extract information from the site.
 
 """
 
+import concurrent.futures
 import re, sys
-import socket
 import urllib
 import urllib.request
 from collections import Counter, defaultdict
 from html.parser import HTMLParser
 
+from wig.classes.planner import ProbeQueue, VersionPlanner, is_templated
+
+
+# the title of a page
+_TITLE = re.compile(r'<title>\s*(.*)\s*</title>')
+
+# urls of the elements that use 'src'
+_SRC_URLS = [re.compile(r'src="(.+?)"'), re.compile(r"src='(.+?)'")]
+
 
 def search_for_urlless(cache, matcher, results, printer, fp_category, fps, tmp_set):
 	for response in cache.get_responses():
@@ -54,18 +63,17 @@ class DiscoverAllCMS:
 
 		# find matches for all the responses in the cache
 		for fp_category in ['cms', 'platform']:
-			for fp_type in self.fps.data[fp_category]:
-				fps = self.fps.data[fp_category][fp_type]['fps']
+			fps = self.fps.get_index(fp_category)
 
-				for response in self.cache.get_responses():
-					matches = self.matcher.get_result(fps, response)
-					for fp in matches:
-						self.results.add_version(fp_category, fp['name'], fp['output'], fp)
+			for response in self.cache.get_responses():
+				matches = self.matcher.get_result(fps, response)
+				for fp in matches:
+					self.results.add_version(fp_category, fp['name'], fp['output'], fp)
 
-						if (fp['name'], fp['output']) not in self.tmp_set:
-							self.printer.print_debug_line('- Found match: %s %s' % (fp['name'], fp['output']), 2)
+					if (fp['name'], fp['output']) not in self.tmp_set:
+						self.printer.print_debug_line('- Found match: %s %s' % (fp['name'], fp['output']), 2)
 
-						self.tmp_set.add((fp['name'], fp['output']))
+					self.tmp_set.add((fp['name'], fp['output']))
 
 
 class DiscoverCMS:
@@ -92,68 +100,59 @@ class DiscoverCMS:
 		self.num_cms_to_find = options['stop_after']
 		self.find_all_cms = options['run_all']
 
+		# narrow down the version instead of requesting all the urls for a cms
+		self.adaptive_version = options['adaptive_version']
+		self.version_confidence = options['version_confidence']
+		self.version_batch_size = options['version_batch_size']
+
 		# only used for pretty printing of debugging info
 		self.tmp_set = set()
 
-		self.queue = defaultdict(list)
-		for fp_type in data['fingerprints'].data['cms']:
-			for fp in data['fingerprints'].data['cms'][fp_type]['fps']:
-				self.queue[fp['url']].append(fp)
+		self.queue = ProbeQueue(data['fingerprints'].get_collapsed('cms'))
 
 
 	def get_queue(self, cms=None):
-		queue = []
 		if cms is None:
-			for _ in range(self.batch_size):
-				try:
-					url, fp_list = self.queue.popitem()
-					queue.append(fp_list)
-				except KeyError:
-					break
+			return self.queue.get_batch(self.batch_size)
 		else:
-			# the following procedure is *not* optimal
-			# the self.queue dict is completely destroyed and
-			# and rebuilt each time this procedure is called :(
+			return self.queue.get_name(cms)
 
-			# create a temp queue dict
-			tmp_queue = defaultdict(list)
 
-			# remove elements from the dict until it is empty
-			while len(self.queue) > 0:
-				url, fp_list = self.queue.popitem()
+	def add_version_matches(self, matches):
+		for fp in matches:
+			self.result.add_version('cms', fp['name'], fp['output'], fp)
+
+			if (fp['name'], fp['output']) not in self.tmp_set:
+				self.tmp_set.add((fp['name'], fp['output']))
+				self.printer.print_debug_line('- Found version: %s %s' % (fp['name'], fp['output']), 2)
 
-				# remove all the elements of a queue entry's list
-				# one-by-one and check if the fingerprints are
-				# belong to the specified 'cms'
-				tmp_list, out_list = [], []
 
-				while len(fp_list) > 0:
-					# remove the fingerprint
-					fp = fp_list.pop()
+	def find_version_adaptive(self, cms):
+		# request the urls for the cms a few at a time, and stop when
+		# the version is known
+		planner = VersionPlanner(self.get_queue(cms), self.version_confidence)
 
-					# if the fingerprint matches the cms, add it to the
-					# out_list for the current url
-					# otherwise add it to the tmp_list
-					if fp['name'] == cms:
-						out_list.append(fp)
-					else:
-						tmp_list.append(fp)
+		# start with the md5 matches found while detecting the cms
+		for versions in self.result.get_md5_matches('cms', cms):
+			planner.add_match(versions)
 
-				# if there are elements in tmp_list (the new list of fps that
-				# that do *not* match the 'cms'), add it to the tmp_queue's entry
-				# for the current url
-				if len(tmp_list) > 0:
-					tmp_queue[url].extend(tmp_list)
+		num_requests = 0
+		while not planner.is_done():
+			queue = planner.get_batch(self.version_batch_size)
+			if not queue:
+				break
 
-				# if matches for the specified cms have been found, add the list
-				# to the fingerprintQueue for the requester
-				if len(out_list) > 0:
-					queue.append(out_list)
+			num_requests += len(queue)
+			for res_fps, response in self.requester.stream('CMS_version', queue):
+				# the versions read from the response are matched separately
+				matches = self.matcher.get_result([fp for fp in res_fps if not is_templated(fp)], response)
+				extracted = self.matcher.get_result([fp for fp in res_fps if is_templated(fp)], response)
+				self.add_version_matches(matches + extracted)
 
-			# replace the queue with the tmp queue
-			self.queue = tmp_queue
+				planner.add_match(fp['output'] for fp in matches)
+				planner.add_extracted(fp['output'] for fp in extracted)
 
-		return queue
+		self.printer.print_debug_line('- Version candidates after %s requests: %s' % (num_requests, ', '.join(sorted(planner.candidates))), 3)
 
 
 	def run(self):
@@ -166,18 +165,17 @@ class DiscoverCMS:
 		while (not stop_searching or self.find_all_cms) and (not len(self.queue) == 0):
 			self.printer.print_debug_line('Checking fingerprint group no. %s ...' % (batch_no, ), 3)
 
-			# set the requester queue
-			results = self.requester.run('CMS', self.get_queue())
-
-			# search for CMS matches
+			# search for CMS matches as the responses arrive
 			cms_matches = []
-			while not results.empty():
-				fingerprints, response = results.get()
-
-				for fp in self.matcher.get_result(fingerprints, response):
+			for fingerprints, response in self.requester.stream('CMS', self.get_queue()):
+				matches = self.matcher.get_result(fingerprints, response)
+				for fp in matches:
 					self.result.add_version('cms', fp['name'], fp['output'], fp)
 					cms_matches.append(fp['name'])
 
+				# let the queue rank the remaining urls
+				self.queue.add_result(fingerprints, set(fp['name'] for fp in matches))
+
 			# search for the found CMS versions
 			for cms in cms_matches:
 
@@ -189,18 +187,12 @@ class DiscoverCMS:
 					self.printer.print_debug_line('- Found CMS match: %s' % (cms, ), 2)
 
 				# set the requester queue with only fingerprints for the cms
-				results = self.requester.run('CMS_version', self.get_queue(cms))
-
-				# find the results
 				self.printer.print_debug_line('Determining CMS version ...', 1)
-				while results.qsize() > 0:
-					res_fps, response = results.get()
-					for fp in self.matcher.get_result(res_fps, response):
-						self.result.add_version('cms', fp['name'], fp['output'], fp)
-
-						if (fp['name'], fp['output']) not in self.tmp_set:
-							self.tmp_set.add((fp['name'], fp['output']))
-							self.printer.print_debug_line('- Found version: %s %s' % (fp['name'], fp['output']), 2)
+				if self.adaptive_version:
+					self.find_version_adaptive(cms)
+				else:
+					for res_fps, response in self.requester.stream('CMS_version', self.get_queue(cms)):
+						self.add_version_matches(self.matcher.get_result(res_fps, response))
 
 				# update the stop criteria
 				detected_cms.append(cms)
@@ -243,11 +235,14 @@ class DiscoverSubdomains:
 	"""
 	Search for sub-domains.
 
-	The current implementation does not wig's requester class
-	which means that proxy, threads, user-agent, etc are not
-	used. This should implemented, but it should be ensured
-	that the cache is not used, as this might impact the results
-	of the version detection.
+	The sub-domains are looked up concurrently, using the shared
+	resolver, and the titles of the sites are fetched through the
+	requester. The cache is not used for these requests, as this
+	might impact the results of the version detection.
+
+	Some domains accept all sub-domains. To detect this, a random
+	sub-domain is checked once per domain, and the sub-domains that
+	return the same site are ignored.
 	"""
 
 	def __init__(self, options, data):
@@ -258,52 +253,74 @@ class DiscoverSubdomains:
 		self.subdomains = data['fingerprints'].data['subdomains']['fps']
 		self.url = options['url']
 		self.printer = data['printer']
+		self.requester = data['requester']
+		self.resolver = data['resolver']
+		self.wildcards = data['wildcards']
+		self.threads = options['threads']
 
 		self.domain = urllib.request.urlparse(self.url).netloc
 		self.domain = '.'.join(self.domain.split(':')[0].split('.')[-2:])
 
 		self.random_domain = 'random98f092f0b7'
-		self.scheme_sets = set([('http', '80'),('https', '443')])
+		self.scheme_sets = [('http', '80'), ('https', '443')]
+
+		# the title of a site is fetched with a short timeout
+		self.timeout = 1
+
+		# the wildcard checks are kept for this many domains
+		self.max_wildcards = 1000
+
+	def resolve(self, subdomain):
+		try:
+			return self.resolver.resolve(subdomain + '.' + self.domain)[0]
+		except Exception:
+			return None
 
-	def check_subdomain(self, subdomain, scheme, port):
+	def check_subdomain(self, subdomain, scheme, port, ip):
 		domain = subdomain + '.' + self.domain
-		
+
+		# try to get the title of the site hosted on the domain
 		try:
-			# lookup the IP of the domain
-			ip = socket.gethostbyname(domain)
-			
-			# try to get the title of the site hosted on the domain
-			try:
-				req = urllib.request.Request(url=scheme + '://' + domain)
-				with urllib.request.urlopen(req, timeout=1) as f:
-					data = f.read().decode('utf-8')
-					title = re.findall(r'<title>\s*(.*)\s*</title>', data)[0].strip()
-					result = (scheme + '://' + domain + ":" + port, title, ip)
-			except:
-				result = None
-		except:
+			response = self.requester.fetch(scheme + '://' + domain, self.timeout)
+			title = _TITLE.search(response.body).group(1).strip()
+			result = (scheme + '://' + domain + ":" + port, title, ip)
+		except Exception:
 			result = None
 
 		return result
 
+	def check_all(self, subdomains, executor):
+		# returns the results for all sub-domains and schemes,
+		# in the order of the sub-domains
+		ips = dict(zip(subdomains, executor.map(self.resolve, subdomains)))
+
+		checks = [(subdomain, scheme, port, ips[subdomain]) for subdomain in subdomains for scheme, port in self.scheme_sets if ips[subdomain] is not None]
+		return [result for result in executor.map(lambda check: self.check_subdomain(*check), checks) if result]
+
+	def get_control_set(self, executor):
+		# check if the site accepts all sub-domains. This is only
+		# done once per domain, for the most recent domains
+		if self.domain not in self.wildcards:
+			results = self.check_all([self.random_domain], executor)
+
+			while len(self.wildcards) >= self.max_wildcards:
+				del self.wildcards[next(iter(self.wildcards))]
+
+			self.wildcards[self.domain] = set((result[1], result[2]) for result in results)
+
+		return self.wildcards[self.domain]
+
 	def run(self):
 		self.printer.print_debug_line('Searching for sub domains ...', 1)
-		
-		# check if the site accepts all sub-domains
-		control_set = set()
-		for scheme, port in self.scheme_sets:
-			domain_test = self.check_subdomain(self.random_domain, scheme, port)
-			if domain_test:
-				control_set.add((domain_test[1], domain_test[2]))
-
-		# check all sub domains
-		for subdomain in self.subdomains:
-			for scheme, port in self.scheme_sets:
-				result = self.check_subdomain(subdomain, scheme, port)
-				if result:
-					# compare the current results to the control
-					if not (result[1], result[2]) in control_set:
-						self.results.add_subdomain(*result)
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+			control_set = self.get_control_set(executor)
+
+			# check all sub domains
+			for result in self.check_all(self.subdomains, executor):
+				# compare the current results to the control
+				if not (result[1], result[2]) in control_set:
+					self.results.add_subdomain(*result)
 
 
 class DiscoverErrorPage:
@@ -358,25 +375,23 @@ class DiscoverInteresting(object):
 		self.cache = data['cache']
 		self.category = "interesting"
 
-		# add the fingerprints to the queue, ensuring that
-		# all fps with the same url, are collected in a list
-		self.queue = defaultdict(list)
-		self.urlless = []
-		for fp in data['fingerprints'].data['interesting']['fps']:
-			if not fp['url'] == "":
-				self.queue[fp['url']].append(fp)
-			else:
-				self.urlless.append(fp)
+		# the fingerprints grouped by url. These are shared
+		# between scans, and must not be modified
+		url_groups = data['fingerprints'].get_url_groups('interesting')
+		self.queue = [fps for url, fps in url_groups.items() if not url == ""]
+		self.urlless = list(url_groups.get("", []))
 
 
 	def run(self):
+		self.probe()
+		self.search_cache()
+
+
+	def probe(self):
 		self.printer.print_debug_line('Detecting interesting files ...', 1)
 
 		# process the results
-		results = self.requester.run('Interesting', list(self.queue.values()))
-
-		while results.qsize() > 0:
-			fps, response = results.get()
+		for fps, response in self.requester.stream('Interesting', self.queue):
 
 			# if the response includes a 404 md5, check if the response
 			# is a redirection to a known error page
@@ -401,6 +416,8 @@ class DiscoverInteresting(object):
 				except:
 					pass
 
+
+	def search_cache(self):
 		# check if there are any of the urlless matches in the cache
 		search_for_urlless(self.cache, self.matcher, self.result, self.printer, self.category, self.urlless, set())
 
@@ -411,16 +428,16 @@ class DiscoverIP(object):
 	Get the IP address of the host
 	"""
 
-	def __init__(self, path):
+	def __init__(self, path, resolver):
 		self.path = path
+		self.resolver = resolver
 
 	def run(self):
 		try:
-			hostname = self.path.split('//')[1]
-			hostname = hostname.split('/')[0]
+			hostname = urllib.request.urlparse(self.path).hostname
 			# changed from 'gethostbyname' to 'gethostbyname_ex' which returns a list of ips
 			# see issue #19
-			ips = socket.gethostbyname_ex(hostname)[2]
+			ips = self.resolver.resolve(hostname)
 		except Exception as e:
 			#print(e)
 			ips = ['Unknown']
@@ -440,9 +457,7 @@ class DiscoverJavaScript(object):
 		self.matcher = data['matcher']
 		self.result = data['results']
 
-		self.fingerprints = []
-		for fp_type in data['fingerprints'].data['js']:
-			self.fingerprints.extend(data['fingerprints'].data['js'][fp_type]['fps'])
+		self.fingerprints = data['fingerprints'].get_index('js')
 
 
 	def run(self):
@@ -532,11 +547,9 @@ class DiscoverMore(object):
 		# only get urls from elements that use 'src' to avoid
 		# fetching resources provided by <a>-tags, as this could
 		# lead to the crawling of the whole application
-		regexes = ['src="(.+?)"', "src='(.+?)'"]
-
 		urls = set()
-		for regex in regexes:
-			for match in re.findall(regex, response.body):
+		for regex in _SRC_URLS:
+			for match in regex.findall(response.body):
 				urls.add(match)
 
 		return urls
@@ -582,7 +595,8 @@ class DiscoverMore(object):
 			queue[url].append({'url': url})
 
 		# fetch'em
-		results = self.requester.run('DiscoverMore', list(queue.values()))
+		for _ in self.requester.stream('DiscoverMore', list(queue.values())):
+			pass
 
 
 class DiscoverOS:
@@ -600,62 +614,53 @@ class DiscoverOS:
 		self.printer = data['printer']
 		self.cache = data['cache']
 		self.results = data['results']
-		self.fingerprints = data['fingerprints'].data['os']['fps']
+		self.index = data['fingerprints'].get_os_index()
 
 		self.os = Counter()
 		self.os_family_list = Counter()
-		self.matched_packages = set()
-
 
-	def search_and_prioritize_os(self, pkg_name, pkg_version):
-		for fp in self.fingerprints:
+		# the packages found in the 'server' headers, with the
+		# number of responses they were found in
+		self.packages = Counter()
 
-			pkg_name_match = fp['pkg_name'].lower() == pkg_name.lower()
-			pkg_version_match = fp['pkg_version'].lower() == pkg_version.lower()
 
-			if pkg_name_match and pkg_version_match:
-				weight = 1 if not 'weight' in fp else fp['weight']
+	def search_and_prioritize_os(self, pkg_name, pkg_version, count=1):
+		for os_name, os_versions, weight in self.index.get((pkg_name.lower(), pkg_version.lower()), []):
+			if os_name.lower() in self.os_family_list:
+				self.printer.print_debug_line('- Prioritizing fingerprints for OS: %s' % (os_name, ), 7)
+				weight *= 100
 
-				if not type(fp['os_version']) == type([]):
-					fp['os_version'] = [fp['os_version']]
+			for os_version in os_versions:
+				self.os[(os_name, os_version)] += weight * count
 
-				for os_version in fp['os_version']:
-					if fp['os_name'].lower() in self.os_family_list:
-						self.printer.print_debug_line('- Prioritizing fingerprints for OS: %s' % (fp['os_name'], ), 7)
-						self.os[(fp['os_name'], os_version)] += weight * 100
-					else:
-						self.os[(fp['os_name'], os_version)] += weight
 
+	def find_match_in_headers(self, line, count=1):
+		# 'line' is the value of a 'server' header, which was
+		# sent in 'count' responses
+		if "(" in line:
+			os = line[line.find('(')+1:line.find(')')]
 
-	def find_match_in_headers(self, response):
-		headers = response.headers
-		if 'server' in headers:
-			line = headers['server']
+			# hack for RHEL
+			if os == 'Red Hat':
+				os = 'Red Hat Enterprise Linux'
 
-			if "(" in line:
-				os = line[line.find('(')+1:line.find(')')]
-
-				# hack for RHEL
-				if os == 'Red Hat':
-					os = 'Red Hat Enterprise Linux'
-
-				line = line[:line.find('(')-1] + line[line.find(')')+1: ]
-			else:
-				os = None
+			line = line[:line.find('(')-1] + line[line.find(')')+1: ]
+		else:
+			os = None
 
-			if os is not None:
-				self.os_family_list[os.lower()] += 1
+		if os is not None:
+			self.os_family_list[os.lower()] += count
 
-			for part in line.split(" "):
-				try:
-					pkg, version = list(map(str.lower, part.split('/')))
-					self.search_and_prioritize_os(pkg, version)
-				except Exception as e:
-					continue
+		for part in line.split(" "):
+			try:
+				pkg, version = list(map(str.lower, part.split('/')))
+				self.packages[(pkg, version)] += count
+			except Exception as e:
+				continue
 
 
 	def find_match_in_results(self):
-		platforms = self.results.scores['platform']
+		platforms = self.results.get_platform_results()
 		for pkg in platforms:
 			for version in platforms[pkg]:
 				# hack for asp.net
@@ -685,12 +690,18 @@ class DiscoverOS:
 
 	def run(self):
 		self.printer.print_debug_line('Detecting OS ...', 1)
-		headers = set()
 		responses = self.cache.get_responses()
 
-		# find matches in the header
-		for response in responses:
-			self.find_match_in_headers(response)
+		# find matches in the header. Most responses have the same
+		# 'server' header, so each distinct header is parsed once
+		servers = Counter(response.headers['server'] for response in responses if 'server' in response.headers)
+		for line, count in servers.items():
+			self.find_match_in_headers(line, count)
+
+		# the OS families of all the headers are known at this
+		# point, so all packages are prioritized the same way
+		for (pkg, version), count in self.packages.items():
+			self.search_and_prioritize_os(pkg, version, count)
 
 		# find match in current results
 		self.find_match_in_results()
@@ -709,13 +720,12 @@ class DiscoverPlatform:
 		self.printer = data['printer']
 		self.threads = options['threads']
 		self.batch_size = options['batch_size']
-		self.queue = defaultdict(list)
 		self.cache = data['cache']
 		self.translator = data['fingerprints'].data['translator']['dictionary']
 
-		for fp_type in data['fingerprints'].data['platform']:
-			for fp in data['fingerprints'].data['platform'][fp_type]['fps']:
-				self.queue[fp['url']].append(fp)
+		# the fingerprints grouped by url. These are shared
+		# between scans, and must not be modified
+		self.queue = list(data['fingerprints'].get_url_groups('platform').values())
 
 		# only used for pretty printing of debugging info
 		self.tmp_set = set()
@@ -723,34 +733,31 @@ class DiscoverPlatform:
 
 
 	def run(self):
-		self.printer.print_debug_line('Detecting platform ...', 1)
+		self.probe()
+		self.search_cache()
 
-		# search for platform information using the platform fingerprints
-		while len(self.queue) > 0:
-			queue = []
-			for i in range(self.batch_size):
-				try:
-					url, fp_list = self.queue.popitem()
-					queue.append(fp_list)
-				except KeyError:
-					break
 
-			results = self.requester.run('Plaform', queue)
+	def probe(self):
+		self.printer.print_debug_line('Detecting platform ...', 1)
 
-			# search for Platform matches
-			while not results.empty():
-				fingerprints, response = results.get()
-				matches = self.matcher.get_result(fingerprints, response)
+		# search for platform information using the platform fingerprints.
+		# There is no need to split the urls into batches, as the
+		# responses are matched as they arrive
+		queue, self.queue = self.queue, []
 
-				for fp in matches:
-					self.result.add_version('platform', fp['name'], fp['output'], fp)
+		for fingerprints, response in self.requester.stream('Plaform', queue):
+			matches = self.matcher.get_result(fingerprints, response)
 
-					if (fp['name'], fp['output']) not in self.tmp_set:
-						self.printer.print_debug_line('- Found platform %s %s' % (fp['name'], fp['output']), 2)
+			for fp in matches:
+				self.result.add_version('platform', fp['name'], fp['output'], fp)
 
-					self.tmp_set.add((fp['name'], fp['output']))
+				if (fp['name'], fp['output']) not in self.tmp_set:
+					self.printer.print_debug_line('- Found platform %s %s' % (fp['name'], fp['output']), 2)
 
+				self.tmp_set.add((fp['name'], fp['output']))
 
+
+	def search_cache(self):
 		# Look for data in all the response headers ('server') in the cache
 		for response in self.cache.get_responses():
 			headers = response.headers
@@ -804,7 +811,7 @@ class DiscoverTitle:
 		front_page = self.data['cache'][self.url]
 
 		try:
-			title = re.findall(r'<title>\s*(.*)\s*</title>', front_page.body)[0]
+			title = _TITLE.search(front_page.body).group(1)
 			title = title.strip()
 		except:
 			title = ''
@@ -823,7 +830,7 @@ class DiscoverTools:
 	"""
 
 	def __init__(self, data):
-		self.translator = data['fingerprints'].data['translator']['dictionary']
+		self.tools = data['fingerprints'].get_tool_index()
 		self.results = data['results']
 		self.printer = data['printer']
 
@@ -838,13 +845,9 @@ class DiscoverTools:
 			cms_set.add(result_object.name)
 
 		for detected_cms in cms_set:
-			# loop over all the translations
-			for cms_name in self.translator:
-				# check if the translated name is the same as the cms
-				if self.translator[cms_name]['name'] == detected_cms and 'tool' in self.translator[cms_name]:
-					for tool in self.translator[cms_name]['tool']:
-						self.results.add_tool(detected_cms, tool['name'], tool['link'])
-						self.printer.print_debug_line('- Found tool: %s (%s)' % (tool['name'], tool['link']), 2)
+			for tool in self.tools.get(detected_cms, []):
+				self.results.add_tool(detected_cms, tool['name'], tool['link'])
+				self.printer.print_debug_line('- Found tool: %s (%s)' % (tool['name'], tool['link']), 2)
 
 
 class DiscoverUrlLess:
@@ -867,12 +870,10 @@ class DiscoverUrlLess:
 		tmp_set = set()
 
 		for fp_category in ['cms', 'platform']:
-			for fp_type in self.fingerprints.data[fp_category]:
-				fps = self.fingerprints.data[fp_category][fp_type]['fps']
-				fps = [fp for fp in fps if fp['url'] == '']
+			fps = self.fingerprints.get_index(fp_category, urlless=True)
 
-				# find matches for all the responses in the cache
-				search_for_urlless(self.cache, self.matcher, self.results, self.printer, fp_category, fps, tmp_set)
+			# find matches for all the responses in the cache
+			search_for_urlless(self.cache, self.matcher, self.results, self.printer, fp_category, fps, tmp_set)
 
 
 
@@ -885,12 +886,7 @@ class DiscoverVulnerabilities:
 	def __init__(self, data):
 		self.printer = data['printer']
 		self.results = data['results']
-		self.fps = []
-
-		vuln_sources = data['fingerprints'].data['vulnerabilities']
-
-		for source in vuln_sources:
-			self.fps.extend(data['fingerprints'].data['vulnerabilities'][source]['fps'])
+		self.index = data['fingerprints'].get_vulnerability_index()
 
 
 	def run(self):
@@ -905,11 +901,10 @@ class DiscoverVulnerabilities:
 			cms, version = result_object
 
 			try:
-				for fp in self.fps:
-					if fp['name'] == cms and fp['version'] == version:
-						self.results.add_vulnerabilities(cms, version, fp['num_vulns'], fp['link'])
-						error = (cms, version, fp['num_vulns'])
-						self.printer.print_debug_line('- Found vulnerability: %s %s: %s' % error, 2)
+				for fp in self.index.get(cms, version):
+					self.results.add_vulnerabilities(cms, version, fp['num_vulns'], fp['link'])
+					error = (cms, version, fp['num_vulns'])
+					self.printer.print_debug_line('- Found vulnerability: %s %s: %s' % error, 2)
 
 			except Exception as e:
 				print(e)
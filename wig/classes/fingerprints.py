@@ -1,12 +1,150 @@
 import json
-import copy
+import marshal
+import hashlib
+import re
+import sqlite3
+import threading
 import os
 import os.path
+import sys
+from collections import defaultdict
+
+from wig import __version__
+from wig.classes.matcher import FingerprintIndex, compile_regex
+
+
+# bump this when the layout of the compiled database changes
+DATABASE_VERSION = 1
+
+
+def _collapse(fps):
+	# fingerprints that only differ in their output are collapsed into
+	# a single entry, with the outputs in 'outputs'. Fingerprints without
+	# an output are kept as they are
+	entries, collapsed = [], {}
+	for fp in fps:
+		if 'output' not in fp:
+			entries.append(fp)
+			continue
+
+		key = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in fp.items() if not k == 'output'))
+		entry = collapsed.get(key)
+		if entry is None:
+			entry = collapsed[key] = {k: v for k, v in fp.items() if not k == 'output'}
+			entry['outputs'] = []
+			entries.append(entry)
+
+		entry['outputs'].append(fp['output'])
+
+	return entries
+
+
+def _compile_regexes(fps, category):
+	# the regular expressions are compiled when the fingerprints are
+	# loaded, so the scans do not have to. Fingerprints with an invalid
+	# regular expression are reported and left out
+	valid = []
+	for fp in fps:
+		if isinstance(fp, dict) and fp.get('type') == 'regex':
+			try:
+				compile_regex(fp['match'])
+			except re.error as e:
+				print('Invalid regex in %s fingerprint: %s (%s)' % (category, fp['match'], e))
+				continue
+
+		valid.append(fp)
+
+	return valid
+
+
+def _normalize_version(version):
+	# '2.2.0-RC1' and '2.2.0 rc1' are the same version, and so are
+	# '3.1' and '3.1.0'
+	version = version.strip().lower()
+	version = re.sub(r'^v(?=\d)', '', version)
+	version = re.sub(r'[\s_-]+', '', version)
+	return re.sub(r'(\.0)+$', '', version)
+
+
+class VulnerabilityIndex(object):
+	"""
+	The vulnerability fingerprints indexed by (name, version).
+
+	A version without an entry of its own is looked up in its
+	normalized form, and then in the version ranges it is part of,
+	e.g. '4.2.2' is looked up as '4.2.x' and then as '4.x'.
+	"""
+
+	def __init__(self, fps):
+		self.exact = defaultdict(list)
+		self.normalized = defaultdict(list)
+
+		for fp in fps:
+			self.exact[(fp['name'], fp['version'])].append(fp)
+			self.normalized[(fp['name'], _normalize_version(fp['version']))].append(fp)
+
+	def get(self, name, version):
+		fps = self.exact.get((name, version))
+		if fps:
+			return fps
+
+		version = _normalize_version(version)
+		fps = self.normalized.get((name, version))
+		if fps:
+			return fps
+
+		parts = version.split('.')
+		for i in range(len(parts) - 1, 0, -1):
+			fps = self.normalized.get((name, '.'.join(parts[:i]) + '.x'))
+			if fps:
+				return fps
+
+		return []
+
+
+class FingerprintData(dict):
+	"""
+	Dictionary holding the fingerprint categories.
+
+	A category is loaded the first time it is accessed, so a scan only
+	pays for the parts of the fingerprint corpus that it actually uses.
+	"""
+
+	def __init__(self, fingerprints):
+		super().__init__()
+		self.fingerprints = fingerprints
+		self.lock = threading.RLock()
+
+	def __missing__(self, category):
+		with self.lock:
+			if not dict.__contains__(self, category):
+				self[category] = self.fingerprints._load_category(category)
+
+		return dict.__getitem__(self, category)
+
+	def __contains__(self, category):
+		return category in self.fingerprints.layout
+
+	def __iter__(self):
+		return iter(self.fingerprints.layout)
+
+	def __len__(self):
+		return len(self.fingerprints.layout)
+
+	def keys(self):
+		return self.fingerprints.layout.keys()
 
 
 class Fingerprints(object):
+	"""
+	The fingerprints used by wig.
+
+	The fingerprints are stored as JSON files in 'data_dir'. These can
+	be compiled into a single database (see compile_database()), which
+	is used instead of the JSON files as long as it is up to date.
+	"""
 
-	def __init__(self, data_dir='data'):
+	def __init__(self, data_dir='data', database=None):
 		# get the absolute location of this file
 		datadir = os.path.dirname(os.path.abspath(__file__))
 
@@ -14,7 +152,10 @@ class Fingerprints(object):
 		datadir = os.path.join(datadir.rsplit(os.sep, maxsplit=1)[0], data_dir)
 		path = lambda *x: os.path.join(datadir,*x)
 
-		self.data = {
+		self.datadir = datadir
+		self.database = database if database is not None else path('fingerprints.db')
+
+		self.layout = {
 			'cms': {
 				'md5':			{'dir': path('cms', 'md5'),	'fps': []},
 				'reqex':		{'dir': path('cms', 'regex'),	'fps': []},
@@ -41,13 +182,17 @@ class Fingerprints(object):
 			'os':			{'dir':  path('os'),			'fps': []}
 		}
 
-		# load fingerprints
-		self._load_subdomains()
-		self._load_dictionary()
-		self._load_interesting()
-		self._load_error()
-		self._load_os()
-		self._load()
+		# the categories with sub types, e.g. 'md5' and 'string'
+		self.typed_categories = ['cms', 'js', 'platform', 'vulnerabilities']
+
+		# None until the database has been checked
+		self.use_database = None
+
+		# compiled matchers, see get_index()
+		self.indexes = {}
+
+		# fingerprints are loaded on first access
+		self.data = FingerprintData(self)
 
 
 	def _is_json(self, filename):
@@ -74,48 +219,323 @@ class Fingerprints(object):
 		return fps
 
 
+	def _get_signature(self):
+		# the signature is used to detect a stale database. It changes
+		# with the version of wig, and when a JSON file is added,
+		# removed or modified. The files are compared by their
+		# modification time and size, to keep the startup fast
+		signature = hashlib.md5()
+		signature.update(('%s %s %s %s' % (DATABASE_VERSION, __version__, marshal.version, sys.version_info[:2])).encode())
+
+		for path, dirs, files in os.walk(self.datadir):
+			dirs.sort()
+			for filename in sorted(files):
+				if not self._is_json(filename): continue
+
+				full_path = os.path.join(path, filename)
+				stat = os.stat(full_path)
+				entry = '%s %s %s' % (os.path.relpath(full_path, self.datadir), stat.st_mtime_ns, stat.st_size)
+				signature.update(entry.encode())
+
+		return signature.hexdigest()
+
+
+	def _query(self, query, args=()):
+		db = sqlite3.connect(self.database)
+		try:
+			return db.execute(query, args).fetchone()
+		finally:
+			db.close()
+
+
+	def _check_database(self):
+		# only use the database if it was compiled from the current JSON files
+		if not os.path.exists(self.database):
+			return False
+
+		try:
+			row = self._query("SELECT value FROM meta WHERE key = 'signature'")
+		except sqlite3.Error:
+			return False
+
+		return row is not None and row[0] == self._get_signature()
+
+
+	def _load_category(self, category):
+		if self.use_database is None:
+			self.use_database = self._check_database()
+
+		content = None
+		if self.use_database:
+			try:
+				row = self._query('SELECT data FROM categories WHERE name = ?', (category, ))
+				if row is not None:
+					content = marshal.loads(row[0])
+			except (sqlite3.Error, ValueError, EOFError, TypeError):
+				content = None
+
+		# fall back to the JSON files
+		if content is None:
+			content = self._load_json(category)
+
+		# fill the layout of the category with the loaded content
+		entry = {key: dict(value) if isinstance(value, dict) else value for key, value in self.layout[category].items()}
+		if category in self.typed_categories:
+			for fp_type in entry:
+				entry[fp_type]['fps'] = _compile_regexes(content.get(fp_type, []), category)
+		elif category == 'translator':
+			entry['dictionary'] = content
+		elif content is not None:
+			entry['fps'] = _compile_regexes(content, category)
+		else:
+			entry['fps'] = content
+
+		return entry
+
+
+	def _load_json(self, category):
+		if category == 'subdomains':
+			return self._load_subdomains()
+		elif category == 'translator':
+			return self._load_dictionary()
+		elif category == 'interesting':
+			return self._load_interesting()
+		elif category == 'error_pages':
+			return self._load_error()
+		elif category == 'os':
+			return self._load_os()
+		else:
+			return self._load(category)
+
+
 	def _load_subdomains(self):
-		self.data['subdomains']['fps'] = self._open_file(self.data['subdomains']['file'])
+		return self._open_file(self.layout['subdomains']['file'])
 
 
 	def _load_dictionary(self):
-		fps = self._open_file(self.data['translator']['file'])
-		if fps is not None:
-			self.data['translator']['dictionary'] = fps
+		fps = self._open_file(self.layout['translator']['file'])
+		return fps if fps is not None else {}
 
 
 	def _load_error(self):
-		fps = self._open_file(self.data['error_pages']['file'])
-		if fps is not None:
-			self.data['error_pages']['fps'] = fps
+		fps = self._open_file(self.layout['error_pages']['file'])
+		return fps if fps is not None else []
 
 
 	def _load_os(self):
-		for json_file in os.listdir(self.data['os']['dir']):
-			fps = self._open_file(self.data['os']['dir'], json_file)
+		os_fps = []
+		for json_file in sorted(os.listdir(self.layout['os']['dir'])):
+			fps = self._open_file(self.layout['os']['dir'], json_file)
 			if fps is not None:
-				self.data['os']['fps'].extend(fps)
+				os_fps.extend(fps)
+
+		return os_fps
 
 
 	def _load_interesting(self):
-		fps = self._open_file(self.data['interesting']['file'])
+		fps = self._open_file(self.layout['interesting']['file'])
 
+		interesting = []
 		for fp in fps:
 			if 'ext' in fp:
 				for ext in fp['ext']:
-					fp_copy = copy.deepcopy(fp)
-					fp_copy['url'] += '.' + ext
-					self.data['interesting']['fps'].append(fp_copy)
+					interesting.append(dict(fp, url=fp['url'] + '.' + ext))
 			else:
-				self.data['interesting']['fps'].append(fp)
+				interesting.append(fp)
+
+		return interesting
+
+
+	def _load(self, category):
+		content = {}
+		for fp_type in self.layout[category]:
+			content[fp_type] = []
+			fp_dir = self.layout[category][fp_type]['dir']
+			for json_file in sorted(os.listdir(fp_dir)):
+				fps = self._open_file(fp_dir, json_file)
+				if fps is None: continue
+
+				for fp in fps:
+					fp['name'] = self._get_name( json_file )
+					content[fp_type].append( fp )
+
+		return content
+
+
+	def compile_database(self):
+		"""
+		Compile the JSON files into a single database.
+
+		Each category is stored as a separate record, which allows
+		the categories to be loaded one at a time. The database is
+		written to a temporary file first, to avoid leaving a broken
+		database behind.
+		"""
+		tmp_file = self.database + '.tmp'
+		if os.path.exists(tmp_file):
+			os.remove(tmp_file)
+
+		db = sqlite3.connect(tmp_file)
+		try:
+			db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+			db.execute('CREATE TABLE categories (name TEXT PRIMARY KEY, num_fps INTEGER, data BLOB)')
+
+			for category in self.layout:
+				content = self._load_json(category)
+				if category in self.typed_categories:
+					num_fps = sum(len(fps) for fps in content.values())
+				else:
+					num_fps = len(content)
+
+				db.execute('INSERT INTO categories VALUES (?, ?, ?)', (category, num_fps, marshal.dumps(content)))
+
+			db.execute('INSERT INTO meta VALUES (?, ?)', ('version', str(DATABASE_VERSION)))
+			db.execute('INSERT INTO meta VALUES (?, ?)', ('signature', self._get_signature()))
+			db.commit()
+		finally:
+			db.close()
+
+		os.replace(tmp_file, self.database)
+		self.use_database = None
+
+		return self.database
 
 
-	def _load(self):
-		categories = ['cms', 'js', 'platform', 'vulnerabilities']
+	def count(self, categories):
+		"""
+		Returns the number of fingerprints in the 'categories'.
+
+		If the database is used, the number is read from it, which
+		avoids loading the categories.
+		"""
+		if self.use_database is None:
+			self.use_database = self._check_database()
+
+		if self.use_database:
+			try:
+				query = 'SELECT SUM(num_fps) FROM categories WHERE name IN (%s)' % (','.join('?' * len(categories)), )
+				return self._query(query, categories)[0] or 0
+			except sqlite3.Error:
+				pass
+
+		num_fps = 0
 		for category in categories:
-			for fp_type in self.data[category]:
-				for json_file in os.listdir(self.data[category][fp_type]['dir']):
-					fps = self._open_file(self.data[category][fp_type]['dir'], json_file)
-					for fp in fps:
-						fp['name'] = self._get_name( json_file )
-						self.data[category][fp_type]['fps'].append( fp )
+			if category in self.typed_categories:
+				num_fps += sum(len(self.data[category][fp_type]['fps']) for fp_type in self.data[category])
+			else:
+				num_fps += len(self.data[category]['fps'])
+
+		return num_fps
+
+
+	def get_collapsed(self, category):
+		"""
+		Returns the fingerprints in 'category', with the fingerprints
+		that only differ in their output collapsed into a single entry.
+		The outputs of an entry are in its 'outputs' list, and the
+		matcher returns a match per output.
+
+		The list is only built once and is shared between scans, so
+		the entries must not be modified.
+		"""
+		key = (category, 'collapsed')
+		if key not in self.indexes:
+			if category in self.typed_categories:
+				fps = []
+				for fp_type in self.data[category]:
+					fps.extend(self.data[category][fp_type]['fps'])
+			else:
+				fps = self.data[category]['fps']
+
+			self.indexes[key] = _collapse(fps)
+
+		return self.indexes[key]
+
+
+	def get_url_groups(self, category):
+		"""
+		Returns the collapsed fingerprints in 'category' grouped by
+		url: url -> tuple of entries. Fingerprints without an url are
+		grouped under ''. The groups are only built once.
+		"""
+		key = (category, 'urls')
+		if key not in self.indexes:
+			groups = defaultdict(list)
+			for fp in self.get_collapsed(category):
+				groups[fp['url']].append(fp)
+
+			self.indexes[key] = {url: tuple(fps) for url, fps in groups.items()}
+
+		return self.indexes[key]
+
+
+	def get_index(self, category, urlless=False):
+		"""
+		Returns a FingerprintIndex of all the fingerprints in 'category'.
+		If 'urlless' is set, only fingerprints without an url are included.
+
+		The index is only built once and is shared between scans.
+		"""
+		key = (category, urlless)
+		if key not in self.indexes:
+			fps = self.get_collapsed(category)
+
+			if urlless:
+				fps = [fp for fp in fps if fp['url'] == '']
+
+			self.indexes[key] = FingerprintIndex(fps)
+
+		return self.indexes[key]
+
+
+	def get_os_index(self):
+		"""
+		Returns the OS fingerprints indexed by package:
+		(pkg_name, pkg_version) -> list of (os_name, os_versions, weight)
+
+		The package names and versions are lower case. The index is
+		only built once and is shared between scans.
+		"""
+		key = ('os', 'packages')
+		if key not in self.indexes:
+			index = defaultdict(list)
+			for fp in self.data['os']['fps']:
+				os_versions = fp['os_version'] if isinstance(fp['os_version'], list) else [fp['os_version']]
+				package = (fp['pkg_name'].lower(), fp['pkg_version'].lower())
+				index[package].append((fp['os_name'], tuple(os_versions), fp.get('weight', 1)))
+
+			self.indexes[key] = dict(index)
+
+		return self.indexes[key]
+
+
+	def get_vulnerability_index(self):
+		"""
+		Returns a VulnerabilityIndex of the vulnerability fingerprints
+		of all sources. The index is only built once.
+		"""
+		key = ('vulnerabilities', 'versions')
+		if key not in self.indexes:
+			fps = []
+			for source in self.data['vulnerabilities']:
+				fps.extend(self.data['vulnerabilities'][source]['fps'])
+
+			self.indexes[key] = VulnerabilityIndex(fps)
+
+		return self.indexes[key]
+
+
+	def get_tool_index(self):
+		"""
+		Returns the tools of the dictionary indexed by the name
+		of the software they are for. The index is only built once.
+		"""
+		key = ('translator', 'tools')
+		if key not in self.indexes:
+			index = defaultdict(list)
+			for entry in self.data['translator']['dictionary'].values():
+				index[entry['name']].extend(entry.get('tool', []))
+
+			self.indexes[key] = dict(index)
+
+		return self.indexes[key]
@@ -1,4 +1,163 @@
 import re
+from collections import defaultdict
+
+
+# compiled regular expressions of the fingerprints. Python's own cache
+# is too small to hold all the patterns used during a scan. The patterns
+# are compiled when the fingerprints are loaded (see Fingerprints)
+_compiled_regexes = {}
+
+def compile_regex(pattern):
+	if pattern not in _compiled_regexes:
+		_compiled_regexes[pattern] = re.compile(pattern)
+	return _compiled_regexes[pattern]
+
+
+def _required_literal(pattern):
+	"""
+	Returns the longest literal string that every match of the regular
+	expression 'pattern' must contain. If no such string can be found,
+	an empty string is returned.
+
+	This is used as a cheap prefilter: the regex is only run on bodies
+	that contain the literal.
+	"""
+	quantifier = re.compile(r'\{(\d*)(?:,\d*)?\}')
+
+	best, current = '', ''
+	depth, i = 0, 0
+	while i < len(pattern):
+		char = pattern[i]
+		literal = None
+
+		if char == '\\':
+			# escaped non-alphanumeric characters are literals,
+			# everything else (\d, \s, \1, ...) is not
+			escaped = pattern[i+1:i+2]
+			if escaped and not escaped.isalnum():
+				literal = escaped
+			i += 2
+
+		elif char == '[':
+			# skip the character class
+			i += 1
+			if pattern[i:i+1] == '^': i += 1
+			if pattern[i:i+1] == ']': i += 1
+			while i < len(pattern) and not pattern[i] == ']':
+				i += 2 if pattern[i] == '\\' else 1
+			i += 1
+
+		elif char == '(':
+			# bail on inline flags, e.g. '(?i)'
+			if pattern[i+1:i+2] == '?' and pattern[i+2:i+3] in list('aiLmsux-'):
+				return ''
+			depth += 1
+			i += 1
+
+		elif char == ')':
+			depth -= 1
+			i += 1
+
+		elif char == '|':
+			# only parts of the pattern are required
+			if depth == 0:
+				return ''
+			i += 1
+
+		elif char in '.^$*+?' or quantifier.match(pattern, i):
+			# quantifiers of non-literals are skipped here
+			match = quantifier.match(pattern, i)
+			i = match.end() if match else i + 1
+
+		else:
+			literal = char
+			i += 1
+
+		if literal is None or depth > 0:
+			best, current = max(best, current, key=len), ''
+			continue
+
+		# check if the literal is repeated or optional
+		match = quantifier.match(pattern, i)
+		if pattern[i:i+1] in ['?', '*'] or (match and match.group(1) in ['', '0']):
+			best, current = max(best, current, key=len), ''
+		elif pattern[i:i+1] == '+' or match:
+			best, current = max(best, current + literal, key=len), ''
+		else:
+			current += literal
+
+	return max(best, current, key=len)
+
+
+class FingerprintIndex(object):
+	"""
+	Precompiled lookup structure for a list of fingerprints.
+
+	md5 fingerprints are stored in a hash map keyed by the digest and
+	header fingerprints are keyed by the lower-cased header name. This
+	way only the fingerprints that can possibly match a response are
+	checked, instead of every fingerprint in the list.
+
+	String and regex fingerprints are grouped by their pattern, so each
+	distinct pattern is searched for once per response body. Regexes are
+	only run if the body contains the literal part of the pattern.
+	"""
+
+	def __init__(self, fingerprints):
+		self.md5 = defaultdict(list)
+		self.headers = defaultdict(list)
+		self.strings = defaultdict(list)
+		self.regexes = defaultdict(list)
+
+		for fingerprint in fingerprints:
+			# fingerprints without a type are never matched
+			if 'type' not in fingerprint:
+				continue
+
+			if 'header' in fingerprint:
+				self.headers[fingerprint['header'].lower()].append(fingerprint)
+
+			elif fingerprint['type'] == 'md5':
+				self.md5[fingerprint['match']].append(fingerprint)
+
+			elif fingerprint['type'] == 'string':
+				self.strings[fingerprint['match']].append(fingerprint)
+
+			elif fingerprint['type'] == 'regex':
+				self.regexes[fingerprint['match']].append(fingerprint)
+
+		# the literals that must be present in a body for a regex to match
+		self.regex_literals = [(_required_literal(regex), fps) for regex, fps in self.regexes.items()]
+
+		for regex in self.regexes:
+			compile_regex(regex)
+
+	def __len__(self):
+		buckets = [self.md5, self.headers, self.strings, self.regexes]
+		return sum(len(fps) for bucket in buckets for fps in bucket.values())
+
+	def get_candidates(self, response, is_image):
+		candidates = []
+
+		# the md5 of a truncated body is not the md5 of the resource
+		if not response.truncated:
+			candidates.extend(self.md5.get(response.md5, []))
+
+		for header in response.headers:
+			candidates.extend(self.headers.get(header, []))
+
+		if not is_image:
+			body = response.body
+			for string, fps in self.strings.items():
+				if string in body:
+					candidates.extend(fps)
+
+			for literal, fps in self.regex_literals:
+				if literal in body:
+					candidates.extend(fps)
+
+		return candidates
+
 
 class Match(object):
 	def __init__(self):
@@ -31,6 +190,10 @@ class Match(object):
 
 
 	def get_result(self, fingerprints, response):
+		"""
+		Match the response against 'fingerprints', which is either
+		a list of fingerprints or a FingerprintIndex.
+		"""
 		# find the matching method to use
 		matches = []
 
@@ -48,6 +211,10 @@ class Match(object):
 		else:
 			is_image = True
 
+		# only check the fingerprints that can match the response
+		if isinstance(fingerprints, FingerprintIndex):
+			fingerprints = fingerprints.get_candidates(response, is_image)
+
 		for fingerprint in fingerprints:
 			match = None
 			
@@ -74,68 +241,89 @@ class Match(object):
 				# fingerprint type is not supported yet
 				match = None
 
-			if match is not None:
-				if match['url'] == '':
-					match['url'] = response.get_url()
+			if match is None:
+				continue
 
+			# do not modify the fingerprint itself, as it is
+			# shared between responses (and scans)
+			if match['url'] == '':
+				match = dict(match, url=response.get_url())
+
+			# a collapsed fingerprint gives a match per output
+			if 'outputs' in match:
+				matches.extend(dict(match, output=output) for output in match['outputs'])
+			else:
 				matches.append(match)
 
 		return matches
 
 	
 	def md5(self, fingerprint, response):
-		if fingerprint["match"] == response.md5:
+		# the md5 of a truncated body is not the md5 of the resource
+		if not response.truncated and fingerprint["match"] == response.md5:
 			return fingerprint
 		else:
 			return None
 
 	
 	def string(self, fingerprint, response):
-		if fingerprint["match"] in response.body:
-			return fingerprint
-		else:
-			return None
+		return self._match_string(fingerprint, response.body)
 
 	
 	def regex(self, fingerprint, response):
-		# create copy of fingerprint
-		copy = {key:fingerprint[key] for key in fingerprint}
-		regex = copy["match"]
-		output = copy["output"] if 'output' in copy else None
-
-		matches = re.findall(regex, response.body)
-		if len(matches):
-			if output is None:
-				copy['output'] = None
-			elif "%" in output:
-				copy['output'] = output % matches[0]
-			
-			return copy
+		return self._match_regex(fingerprint, response.body)
+
+
+	def _match_string(self, fingerprint, text):
+		if fingerprint["match"] in text:
+			return fingerprint
 		else:
 			return None
 
+
+	def _match_regex(self, fingerprint, text):
+		match = compile_regex(fingerprint["match"]).search(text)
+		if match is None:
+			return None
+
+		# the same value re.findall() would return first
+		groups = match.groups(default='')
+		if len(groups) == 0:
+			first = match.group(0)
+		elif len(groups) == 1:
+			first = groups[0]
+		else:
+			first = groups
+
+		# the fingerprint is only copied on a match, as the
+		# output might be filled in with the matched text
+		copy = dict(fingerprint)
+		if 'outputs' in copy:
+			copy['outputs'] = [self._format_output(output, first) for output in copy['outputs']]
+		else:
+			copy['output'] = self._format_output(copy.get('output'), first)
+
+		return copy
+
 	
-	def header(self, fingerprint, response):
-		fp_header = fingerprint['header']
-		match_type = fingerprint['type']
+	def _format_output(self, output, first):
+		# outputs with a '%' are filled in with the first match
+		if output is not None and "%" in output:
+			return output % first
 
-		# a dummy class to mimic a response
-		class response_dummy(object):
-			self.body = ''
+		return output
 
-		# parse the headers searching for a match
-		for header in response.headers:
-			if header == fp_header.lower():
 
-				# create an intance of the dummy class
-				r = response_dummy()
-				r.body = response.headers[header]
+	def header(self, fingerprint, response):
+		# the header names of the responses are lower case
+		value = response.headers.get(fingerprint['header'].lower())
+		if value is None:
+			return None
 
-				# call the Match instances methods for string or regex matching
-				if match_type == 'string':
-					return self.string(fingerprint, r)
-				elif match_type == 'regex':
-					return self.regex(fingerprint, r)
+		if fingerprint['type'] == 'string':
+			return self._match_string(fingerprint, value)
+		elif fingerprint['type'] == 'regex':
+			return self._match_regex(fingerprint, value)
 
 
 
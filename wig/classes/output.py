@@ -1,6 +1,20 @@
 import re, json
 from collections import defaultdict, namedtuple
 
+
+# prefixes removed from the versions in the output
+_VERSION_PREFIXES = [
+	re.compile('^wmf/'),
+	re.compile('^develsnap_'),
+	re.compile('^release_candidate_'),
+	re.compile('^release_stable_'),
+	re.compile('^release[-|_]', re.IGNORECASE),	# Umbraco, phpmyadmin
+	re.compile('^[R|r][E|e][L|l]_'),
+	re.compile('^mt'),					# Movable Type
+	re.compile('^mybb_'),				# myBB
+]
+
+
 class Output:
 	def __init__(self, options, data):
 		self.results = None
@@ -8,27 +22,15 @@ class Output:
 		self.options = options
 
 		# calc the amount of fingerprints
-		fps = data['fingerprints'].data
-		num_fps_js		= sum([len(fps['js'][fp_type]['fps']) for fp_type in fps['js']])
-		num_fps_os		= len(fps['os']['fps'])
-		num_fps_cms		= sum([len(fps['cms'][fp_type]['fps']) for fp_type in fps['cms']])
-		num_fps_plat	= sum([len(fps['platform'][fp_type]['fps']) for fp_type in fps['platform']])
-		num_fps_vuln	= sum([len(fps['vulnerabilities'][source]['fps']) for source in fps['vulnerabilities']])
-		self.num_fps = num_fps_js + num_fps_os + num_fps_cms + num_fps_plat + num_fps_vuln
+		self.num_fps = data['fingerprints'].count(['js', 'os', 'cms', 'platform', 'vulnerabilities'])
 
 		self.ip = self.title = self.cookies = None
 
 	def replace_version_text(self, text):
 		# replace text in version output with something else
 		# (most likely an emtpy string) to improve output
-		text = re.sub('^wmf/', '', text)
-		text = re.sub('^develsnap_', '', text)
-		text = re.sub('^release_candidate_', '', text)
-		text = re.sub('^release_stable_', '', text)
-		text = re.sub('^release[-|_]', '', text, flags=re.IGNORECASE)	# Umbraco, phpmyadmin
-		text = re.sub('^[R|r][E|e][L|l]_', '', text)				
-		text = re.sub('^mt', '', text)				# Movable Type
-		text = re.sub('^mybb_', '', text)			# myBB
+		for regex in _VERSION_PREFIXES:
+			text = regex.sub('', text)
 		return text
 
 	def get_results_of_type(self, result_type):
@@ -43,10 +45,29 @@ class Output:
 
 
 class OutputJSON(Output):
+	"""
+	Writes the results to a JSON file.
+
+	By default all the sites are collected and written as a list
+	when write_file() is called. If options['json_lines'] is set,
+	each site is written as a line of its own when it is added.
+	"""
+
 	def __init__(self, options, data):
 		super().__init__(options, data)
 		self.json_data = []
-	
+		self.json_lines_file = None
+
+		if options['json_lines']:
+			self.json_lines_file = open(options['write_file'] + '.jsonl', 'w')
+
+	def add_site(self, site):
+		if self.json_lines_file is None:
+			self.json_data.append(site)
+		else:
+			self.json_lines_file.write(json.dumps(site, sort_keys=True) + '\n')
+			self.json_lines_file.flush()
+
 	def add_results(self):
 		self.results = self.data['results'].results
 		site_info = self.data['results'].site_info
@@ -56,7 +77,12 @@ class OutputJSON(Output):
 				'start_time': self.data['timer'],
 				'run_time': self.data['runtime'],
 				'urls': self.data['url_count'],
-				'fingerprints': self.num_fps
+				'fingerprints': self.num_fps,
+				'connection_pool': self.data['requester'].pool.get_stats(),
+				'requests': self.data['requester'].controller.get_stats(),
+				'failures': self.data['requester'].get_failures(),
+				'head_policy': self.data['requester'].head_policy.get_stats(),
+				'dns': self.data['resolver'].get_stats(self.data['dns_stats'])
 			},
 			'site_info': {
 				'url': self.options['url'],
@@ -85,10 +111,10 @@ class OutputJSON(Output):
 		# VULNERABILITIES
 		site['data'].extend([{'category': 'Vulnerability', 'name': v.software, 'version': v.version, 'link': v.link, 'num': v.num_vuln} for v in get('Vulnerability')])
 
-		self.json_data.append(site)
+		self.add_site(site)
 
 	def add_error(self, msg):
-		self.json_data.append({
+		self.add_site({
 			'site_info': {
 				'url': self.options['url'],
 				'error': msg
@@ -96,6 +122,10 @@ class OutputJSON(Output):
 		})
 
 	def write_file(self):
+		if self.json_lines_file is not None:
+			self.json_lines_file.close()
+			return
+
 		file_name = self.options['write_file']
 		with open(file_name+ '.json', 'w') as fh:
 			fh.write(json.dumps(self.json_data, sort_keys=True, indent=4, separators=(',', ': ')))
@@ -0,0 +1,258 @@
+"""
+Planning of the requests made to detect the CMS.
+
+"""
+
+import math
+from collections import defaultdict
+
+
+class ProbeQueue(object):
+	"""
+	The urls that have not been requested yet, with their fingerprints.
+
+	The queue is indexed both by url and by the name of the fingerprints,
+	so the urls of a single CMS can be taken out of the queue without
+	going through the rest of the queue.
+
+	The urls are ranked by how much their responses can tell apart:
+	a url has a value for each CMS it has fingerprints for, which
+	grows with the number of versions the url can distinguish. Each
+	CMS has a weight, which is decayed every time one of its urls is
+	requested without a match, so the urls of the CMSes that are
+	still likely are requested first. The urls are ranked again for
+	each batch.
+	"""
+
+	def __init__(self, fingerprints, decay=0.5):
+		# url -> name -> list of fingerprints
+		self.urls = {}
+
+		# name -> urls (a dict is used to keep the order)
+		self.names = {}
+
+		for fp in fingerprints:
+			self.urls.setdefault(fp['url'], {}).setdefault(fp['name'], []).append(fp)
+			self.names.setdefault(fp['name'], {})[fp['url']] = None
+
+		# url -> name -> the value of the url for the name
+		self.values = {}
+		for url, entry in self.urls.items():
+			self.values[url] = {}
+			for name, fps in entry.items():
+				versions = len(set(output for fp in fps for output in fp['outputs']))
+				self.values[url][name] = 1 + math.log2(max(versions, 1))
+
+		self.weights = {name: 1.0 for name in self.names}
+		self.decay = decay
+
+
+	def __len__(self):
+		return len(self.urls)
+
+
+	def _get_value(self, url):
+		return sum(self.weights[name] * value for name, value in self.values[url].items())
+
+
+	def _remove_url(self, url):
+		entry = self.urls.pop(url)
+		del self.values[url]
+
+		fp_list = []
+		for name in entry:
+			fp_list.extend(entry[name])
+
+			urls = self.names[name]
+			del urls[url]
+			if not urls:
+				del self.names[name]
+
+		return fp_list
+
+
+	def get_batch(self, size):
+		"""
+		Removes the 'size' most valuable urls from the queue, and
+		returns a list with the fingerprints of each url.
+
+		The urls are picked one at a time, and the weights of the
+		CMSes of a picked url are decayed right away, so a batch
+		covers as many different CMSes as possible.
+		"""
+		queue = []
+		while len(queue) < size and self.urls:
+			url = max(self.urls, key=self._get_value)
+			for name in self.values[url]:
+				self.weights[name] *= self.decay
+
+			queue.append(self._remove_url(url))
+
+		return queue
+
+
+	def get_name(self, name):
+		"""
+		Removes the fingerprints for 'name' from the queue, and returns
+		them as a list per url. Urls with fingerprints for other names are
+		kept in the queue with the remaining fingerprints.
+		"""
+		queue = []
+		for url in self.names.pop(name, {}):
+			entry = self.urls[url]
+			queue.append(entry.pop(name))
+			del self.values[url][name]
+
+			if not entry:
+				del self.urls[url]
+				del self.values[url]
+
+		return queue
+
+
+	def add_result(self, fp_list, matched_names):
+		"""
+		Updates the weights with the result of a request for the
+		fingerprints in 'fp_list'. The weights were decayed when the
+		url was picked, so this is undone for the CMSes that matched.
+		"""
+		for name in set(fp['name'] for fp in fp_list):
+			if name in matched_names and name in self.weights:
+				self.weights[name] /= self.decay
+
+
+def is_templated(fp):
+	# outputs with '%' are filled in from the response, e.g. the
+	# version read from a CHANGELOG, and are not versions themselves
+	return any(output and '%' in output for output in fp['outputs'])
+
+
+class VersionPlanner(object):
+	"""
+	Narrows down the version of a detected CMS with as few requests
+	as possible.
+
+	The planner keeps the set of versions that are still possible.
+	The next urls to request are the ones expected to leave the fewest
+	candidates, i.e. the ones that best split the candidates into
+	groups with different responses. Only matches narrow the set, as
+	a missing match can also be caused by a removed or modified file.
+	The planner is done when a single version is left, or when the
+	share of the best version of the scores reaches 'confidence'.
+
+	Urls with fingerprints that read the version from the response
+	cannot be ranked this way, so they are always in the first batch.
+	"""
+
+	def __init__(self, fp_lists, confidence):
+		self.confidence = confidence
+
+		self.templated = [fp_list for fp_list in fp_lists if any(is_templated(fp) for fp in fp_list)]
+		self.fp_lists = [fp_list for fp_list in fp_lists if not any(is_templated(fp) for fp in fp_list)]
+
+		self.candidates = set()
+		for fp_list in fp_lists:
+			for fp in fp_list:
+				if not is_templated(fp):
+					self.candidates.update(output for output in fp['outputs'] if output)
+
+		self.scores = defaultdict(float)
+
+
+	def _get_groups(self, fp_list):
+		# group the candidates by the response they give for the url
+		groups = defaultdict(set)
+		for fp in fp_list:
+			outputs = self.candidates.intersection(fp['outputs'])
+			if outputs:
+				key = (fp.get('type'), fp.get('header'), fp['match'])
+				groups[key].update(outputs)
+
+		return groups.values()
+
+
+	def _get_expected_size(self, fp_list):
+		# the expected number of candidates left after requesting the url
+		total = len(self.candidates)
+		groups = self._get_groups(fp_list)
+
+		covered = set()
+		size = 0
+		for group in groups:
+			covered.update(group)
+			size += len(group) ** 2
+
+		# the candidates without a response stay the same
+		size += (total - len(covered)) * total
+
+		return size / total
+
+
+	def add_match(self, versions):
+		"""
+		Narrows the candidates to 'versions', the versions matched
+		by a single response. Matches that conflict with the
+		candidates are ignored.
+		"""
+		versions = set(versions) & self.candidates
+		if not versions:
+			return
+
+		self.candidates = versions
+		for version in versions:
+			self.scores[version] += 1 / len(versions)
+
+
+	def add_extracted(self, versions):
+		"""
+		Sets the candidates to 'versions', the versions read from a
+		single response. These are trusted over the other matches,
+		and are kept even if no other fingerprint knows them.
+		"""
+		versions = set(version for version in versions if version)
+		if not versions:
+			return
+
+		self.candidates = versions
+		for version in versions:
+			self.scores[version] += 1 / len(versions)
+
+
+	def is_done(self):
+		if self.templated:
+			return False
+
+		if len(self.candidates) <= 1:
+			return True
+
+		scores = [self.scores[version] for version in self.candidates]
+		total = sum(scores)
+
+		return total > 0 and max(scores) / total >= self.confidence
+
+
+	def get_batch(self, size):
+		"""
+		Removes up to 'size' of the urls that best split the candidates,
+		and returns the fingerprints of each url. Urls that cannot reduce
+		the candidates are not returned. The urls with fingerprints that
+		read the version from the response are all returned in the
+		first batch, even if there are more than 'size' of them.
+		"""
+		queue, self.templated = self.templated, []
+
+		total = len(self.candidates)
+		ranked = []
+		if total > 1:
+			for i, fp_list in enumerate(self.fp_lists):
+				expected = self._get_expected_size(fp_list)
+				if expected < total:
+					ranked.append((expected, i))
+
+		ranked.sort()
+		picked = set(i for _, i in ranked[:max(0, size - len(queue))])
+
+		queue.extend(self.fp_lists[i] for i in sorted(picked))
+		self.fp_lists = [fp_list for i, fp_list in enumerate(self.fp_lists) if i not in picked]
+
+		return queue
@@ -0,0 +1,154 @@
+"""
+Rate limiting and concurrency control for the requests made to a host.
+
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class TokenBucket(object):
+	"""
+	Limits the number of requests per second.
+
+	The bucket holds up to 'burst' tokens, and is refilled with 'rate'
+	tokens per second. Each request takes a token. If the bucket is
+	empty, the request has to wait until a token is available.
+	"""
+
+	def __init__(self, rate, burst=None):
+		self.rate = rate
+		self.burst = burst if burst is not None else max(1, rate)
+		self.tokens = self.burst
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def reserve(self):
+		"""
+		Takes a token, and returns the number of seconds to wait
+		before it can be used
+		"""
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+			self.last = now
+			self.tokens -= 1
+
+			return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ConcurrencyController(object):
+	"""
+	Controls the number of requests in flight using AIMD (additive
+	increase, multiplicative decrease), as TCP does.
+
+	The limit starts low and is doubled every round trip (slow start)
+	as long as the latency is stable. After that it is increased by one
+	every round trip. When the latency rises, the limit stops growing.
+	When a request times out or the host responds with 429 or 503, the
+	limit is halved, at most once per round trip.
+	"""
+
+	def __init__(self, max_limit, min_limit=1, initial_limit=4, tolerance=2.0):
+		self.max_limit = max(max_limit, min_limit)
+		self.min_limit = min_limit
+		self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+		self.tolerance = tolerance
+
+		self.in_flight = 0
+		self.slow_start = True
+		self.condition = threading.Condition()
+
+		# latency in seconds: the lowest seen, and a moving average
+		self.min_latency = None
+		self.avg_latency = None
+		self.last_decrease = 0
+
+		# statistics
+		self.latencies = deque(maxlen=10000)
+		self.num_requests = 0
+		self.num_congested = 0
+		self.start_time = None
+		self.end_time = None
+
+	def try_acquire(self):
+		with self.condition:
+			if self.in_flight >= int(self.limit):
+				return False
+
+			self.in_flight += 1
+			if self.start_time is None:
+				self.start_time = time.monotonic()
+
+			return True
+
+	def acquire(self):
+		with self.condition:
+			while not self.try_acquire():
+				self.condition.wait()
+
+	def _is_stable(self, latency):
+		if self.min_latency is None or latency < self.min_latency:
+			self.min_latency = latency
+
+		if self.avg_latency is None:
+			self.avg_latency = latency
+		else:
+			self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+
+		# a small constant is added to ignore jitter on fast hosts
+		return self.avg_latency <= self.min_latency * self.tolerance + 0.05
+
+	def release(self, latency=None, congested=False):
+		"""
+		Marks a request as done. 'latency' is the time the request took,
+		and 'congested' tells if the host signaled that it is overloaded
+		"""
+		with self.condition:
+			self.in_flight -= 1
+			self.num_requests += 1
+			self.end_time = time.monotonic()
+
+			if congested:
+				self.num_congested += 1
+				self.slow_start = False
+
+				# only decrease once per round trip, as the requests
+				# in flight were sent with the old limit
+				round_trip = self.avg_latency or 0
+				if self.end_time - self.last_decrease > round_trip:
+					self.limit = max(self.min_limit, self.limit / 2)
+					self.last_decrease = self.end_time
+
+			elif latency is not None:
+				self.latencies.append(latency)
+
+				if not self._is_stable(latency):
+					self.slow_start = False
+				elif self.slow_start:
+					self.limit = min(self.max_limit, self.limit + 1)
+				else:
+					self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+			self.condition.notify_all()
+
+	def get_stats(self):
+		with self.condition:
+			latencies = sorted(self.latencies)
+			duration = (self.end_time or 0) - (self.start_time or 0)
+
+			percentile = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4) if latencies else None
+
+			return {
+				'requests': self.num_requests,
+				'requests_per_second': round(self.num_requests / duration, 2) if duration > 0 else None,
+				'congested': self.num_congested,
+				'limit': int(self.limit),
+				'max_limit': self.max_limit,
+				'latency': {
+					'p50': percentile(0.5),
+					'p90': percentile(0.9),
+					'p99': percentile(0.99)
+				}
+			}
@@ -1,12 +1,23 @@
+import asyncio
 import concurrent.futures
 import hashlib
+import http.client
+import io
+import os
 import re
-import string
-import random
+import socket
+import ssl
+import threading
+import time
+import urllib.error
 import urllib.request
+import urllib.response
 import urllib.parse
+from collections import defaultdict
 from html.parser import HTMLParser
 
+from wig.classes.ratelimit import TokenBucket, ConcurrencyController
+
 
 class HTMLStripper(HTMLParser):
 	def __init__(self):
@@ -20,32 +31,63 @@ class HTMLStripper(HTMLParser):
 		return ''.join(self.tagtext)
 
 
+# patterns used by _clean_page(). The substitutions are applied in
+# the same order as nmap's clean_404, but the ones that cannot affect
+# each other are combined
+_CLEAN_TIME = re.compile(rb'(?:\d?\d:?){2,3}')
+
+# same as removing 'AM' and then 'PM', as removing 'AM' can create a new 'PM'
+_CLEAN_AM_PM = re.compile(rb'AM|P(?:AM)*M', re.IGNORECASE)
+
+# the date patterns only match digits, '-' and '/', and are at least six
+# characters long. Removing a date cannot join two runs of these, so the
+# patterns are applied to each run instead of to the whole page
+_CLEAN_DATE_RUNS = re.compile(rb'[\d/-]{6,}')
+_CLEAN_DATES = [re.compile(pattern) for pattern in [
+	# timestamp
+	rb'\d{13}',
+
+	# date with 4 digit year
+	rb'\d{8}',
+	rb'\d{4}-\d{2}-\d{2}',
+	rb'\d{4}/\d{2}/\d{2}',
+	rb'\d{2}-\d{2}-\d{4}',
+	rb'\d{2}/\d{2}/\d{4}',
+
+	# date with 2 digit year
+	rb'\d{6}',
+	rb'\d{2}-\d{2}-\d{2}',
+	rb'\d{2}/\d{2}/\d{2}',
+]]
+
+# links and paths. nmap also removes windows paths, but the pattern
+# wig used for this never matched, so it is left out to keep the
+# error page fingerprints unchanged
+_CLEAN_PATHS = re.compile(rb'/[^ ]+')
+
+
+def _clean_dates(match):
+	run = match.group(0)
+	for pattern in _CLEAN_DATES:
+		run = pattern.sub(b'', run)
+
+	return run
+
+
 def _clean_page(page):
 	# this the same method nmap's http.lua uses for error page detection
 	# nselib/http.lua: clean_404
 	# remove information from the page that might not be static
-	
+
 	# time
-	page = re.sub(b'(\d?\d:?){2,3}', b'',page)
-	page = re.sub(b'AM', b'',page, flags=re.IGNORECASE)
-	page = re.sub(b'PM', b'',page, flags=re.IGNORECASE)
-	page = re.sub(b'(\d){13}', b'', page) # timestamp
+	page = _CLEAN_TIME.sub(b'', page)
+	page = _CLEAN_AM_PM.sub(b'', page)
 
-	# date with 4 digit year
-	page = re.sub(b'(\d){8}', '',page)
-	page = re.sub(b'\d{4}-\d{2}-\d{2}', b'',page)
-	page = re.sub(b'\d{4}/\d{2}/\d{2}', b'',page)
-	page = re.sub(b'\d{2}-\d{2}-\d{4}', b'',page)
-	page = re.sub(b'\d{2}/\d{2}/\d{4}', b'',page)
+	# dates and timestamps
+	page = _CLEAN_DATE_RUNS.sub(_clean_dates, page)
 
-	# date with 2 digit year
-	page = re.sub( b'(\d){6}', '',page)
-	page = re.sub( b'\d{2}-\d{2}-\d{2}', b'',page)
-	page = re.sub( b'\d{2}/\d{2}/\d{2}', b'',page)
-	
 	# links and paths
-	page = re.sub( b'/[^ ]+',  b'', page)
-	page = re.sub( b'[a-zA-Z]:\\[^ ]+',  b'', page)
+	page = _CLEAN_PATHS.sub(b'', page)
 
 	# return the fingerprint of the stripped page 
 	return hashlib.md5(page).hexdigest().lower()
@@ -56,22 +98,16 @@ def _create_response(response):
 
 	url = response.geturl()
 	response_info = urllib.request.urlparse(url)
-	body = response.read()
 
-	# get the page text only
-	parser = HTMLStripper()
-	parser.feed(body.decode('utf-8', 'ignore'))
-	page_text = parser.get_tagtext()
-
-	R.set_body(body)
+	# the body is decoded and cleaned when it is first needed
+	R.raw = response.read()
 	R.protocol = response_info.scheme
 	R.host = response_info.netloc
 	R.url = url
 	R.status = {'code': response.code, 'text': response.reason}
 	R.headers = {pair[0].lower():pair[1] for pair in response.getheaders()}
-	R.md5 = hashlib.md5(body).hexdigest().lower()
-	R.md5_404 = _clean_page(body)
-	R.md5_404_text = _clean_page(page_text.encode('utf-8', 'ignore'))
+	R.md5 = hashlib.md5(R.raw).hexdigest().lower()
+	R.truncated = getattr(response, 'truncated', False)
 
 	return(R)
 
@@ -99,11 +135,64 @@ class UnknownHostName(Exception):
 		return "Unknown host: %s" % (self.url,)
 
 
+def _is_timeout(err):
+	if isinstance(err, urllib.error.URLError):
+		err = err.reason
+
+	return isinstance(err, (socket.timeout, TimeoutError, asyncio.TimeoutError))
+
+
+def _classify_error(err):
+	# returns the kind of a request error, used for the statistics
+	# and to decide if the request should be retried
+	if isinstance(err, OutOfScopeException):
+		return 'out_of_scope'
+
+	if _is_timeout(err):
+		return 'timeout'
+
+	if isinstance(err, urllib.error.URLError):
+		err = err.reason
+
+	if isinstance(err, socket.gaierror):
+		return 'dns'
+	elif isinstance(err, ssl.SSLError):
+		return 'ssl'
+	elif isinstance(err, ConnectionRefusedError):
+		return 'refused'
+	elif isinstance(err, (ConnectionError, http.client.RemoteDisconnected, asyncio.IncompleteReadError)):
+		return 'connection'
+	elif isinstance(err, http.client.HTTPException):
+		return 'protocol'
+	else:
+		return 'other'
+
+
+# errors that might not happen if the request is made again
+TRANSIENT_ERRORS = ('timeout', 'connection')
+
+
+# status codes used by hosts to signal that they are overloaded
+CONGESTION_CODES = (429, 503)
+
+
 class ErrorHandler(urllib.request.HTTPDefaultErrorHandler):
 	def http_error_default(self, req, fp, code, msg, hdrs):
 		return(fp)
 
 
+def check_redirect_scope(url, location):
+	org_url = urllib.request.urlparse(url)
+	new_url = urllib.request.urlparse(location)
+
+	# if the location starts with '/' the path is relative
+	if location.startswith('/'):
+		new_url = new_url._replace(scheme=org_url.scheme, netloc=org_url.netloc)
+
+	if not new_url.netloc == org_url.netloc:
+		raise OutOfScopeException(org_url, new_url)
+
+
 class RedirectHandler(urllib.request.HTTPRedirectHandler):
 	"""
 	This currently only checks if the redirection netloc is 
@@ -115,15 +204,7 @@ class RedirectHandler(urllib.request.HTTPRedirectHandler):
 
 	def http_error_302(self, req, fp, code, msg, headers):
 		if 'location' in headers:
-			org_url = urllib.request.urlparse(req.get_full_url())
-			new_url = urllib.request.urlparse(headers['location'])
-
-			# if the location starts with '/' the path is relative
-			if headers['location'].startswith('/'):
-				new_url = new_url._replace(scheme=org_url.scheme, netloc=org_url.netloc)
-
-			if not new_url.netloc == org_url.netloc:
-				raise OutOfScopeException(org_url, new_url)
+			check_redirect_scope(req.get_full_url(), headers['location'])
 
 		# call python's built-in redirection handler
 		return urllib.request.HTTPRedirectHandler.http_error_302(self, req, fp, code, msg, headers)
@@ -131,6 +212,333 @@ class RedirectHandler(urllib.request.HTTPRedirectHandler):
 	http_error_301 = http_error_303 = http_error_307 = http_error_302
 
 
+#######################################################################
+#
+# Connection pooling
+#
+#######################################################################
+
+class ConnectionPool(object):
+	"""
+	Keeps idle keep-alive connections, so they can be reused by
+	later requests to the same host.
+
+	At most 'maxsize' idle connections are kept per host. The pool
+	counts the number of requests that reused a connection (hits)
+	and the number of requests that needed a new one (misses).
+	"""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.idle = defaultdict(list)
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, create):
+		with self.lock:
+			if self.idle[key]:
+				self.hits += 1
+				return self.idle[key].pop(), True
+
+			self.misses += 1
+
+		return create(), False
+
+	def put(self, key, connection):
+		with self.lock:
+			if len(self.idle[key]) < self.maxsize:
+				self.idle[key].append(connection)
+				return
+
+		connection.close()
+
+	def close(self):
+		with self.lock:
+			for key in self.idle:
+				for connection in self.idle[key]:
+					connection.close()
+
+			self.idle.clear()
+
+	def get_stats(self):
+		return {'hits': self.hits, 'misses': self.misses}
+
+
+class BodyReader(object):
+	"""
+	Collects the chunks of a response body.
+
+	Reading stops when 'limit' bytes have been read, or when all the
+	byte strings in 'patterns' have been found, as the rest of the body
+	is not needed to match string fingerprints.
+	"""
+
+	chunk_size = 64 * 1024
+
+	def __init__(self, limit=None, patterns=None):
+		self.body = bytearray()
+		self.limit = limit
+		self.pending = set(patterns or [])
+		self.early_stop = bool(self.pending)
+		self.stopped = False
+
+		# set if bytes beyond the limit were read and dropped
+		self.cut_off = False
+
+	def feed(self, chunk):
+		"""
+		Adds a chunk, and returns True if no more should be read
+		"""
+		start = len(self.body)
+		self.body += chunk
+
+		if self.early_stop:
+			for pattern in list(self.pending):
+				# the pattern might start in the previous chunk
+				if self.body.find(pattern, max(0, start - len(pattern) + 1)) != -1:
+					self.pending.discard(pattern)
+
+			self.stopped = not self.pending
+
+		if self.limit is not None and len(self.body) >= self.limit:
+			self.cut_off = len(self.body) > self.limit
+			del self.body[self.limit:]
+			self.stopped = True
+
+		return self.stopped
+
+	def get_body(self):
+		return bytes(self.body)
+
+
+class HeadPolicy(object):
+	"""
+	Learns if 'HEAD' requests are worth using for a host.
+
+	A 'HEAD' request before a 'GET' only saves a request when the
+	resource does not exist. 'HEAD' is no longer used when most of
+	the resources exist, when the host does not support it (405 or
+	501), or when 'HEAD' and 'GET' give different status codes for
+	the same resource. To detect the latter, the first resources
+	reported missing by 'HEAD' are also fetched with 'GET'.
+	"""
+
+	UNSUPPORTED_CODES = (405, 501)
+
+	def __init__(self, min_samples=20, max_found=0.5, verify_samples=3):
+		self.min_samples = min_samples
+		self.max_found = max_found
+		self.verify_samples = verify_samples
+
+		self.enabled = True
+		self.reason = None
+		self.lock = threading.Lock()
+
+		self.num_head = 0
+		self.num_found = 0
+		self.num_verified = 0
+		self.num_mismatches = 0
+
+	def _disable(self, reason):
+		if self.enabled:
+			self.enabled = False
+			self.reason = reason
+
+	def use_head(self):
+		with self.lock:
+			return self.enabled
+
+	def should_get(self, code):
+		"""
+		Adds the status code of a 'HEAD' request, and returns True
+		if the resource should be fetched with a 'GET'
+		"""
+		with self.lock:
+			self.num_head += 1
+			if code in self.UNSUPPORTED_CODES:
+				self._disable('unsupported')
+				return True
+
+			if code == 200:
+				self.num_found += 1
+
+			if self.num_head >= self.min_samples and self.num_found / self.num_head > self.max_found:
+				self._disable('most_exist')
+
+			if code == 200:
+				return True
+
+			if self.num_verified < self.verify_samples:
+				self.num_verified += 1
+				return True
+
+			return False
+
+	def add_result(self, head_code, get_code):
+		"""
+		Compares the status codes of a 'HEAD' and a 'GET' request
+		for the same resource
+		"""
+		if head_code in self.UNSUPPORTED_CODES:
+			return
+
+		with self.lock:
+			if (head_code == 200) != (get_code == 200):
+				self.num_mismatches += 1
+				self._disable('inconsistent')
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				'use_head': self.enabled,
+				'reason': self.reason,
+				'head_requests': self.num_head,
+				'found': self.num_found,
+				'verified': self.num_verified,
+				'mismatches': self.num_mismatches
+			}
+
+
+class PooledResponse(urllib.response.addinfourl):
+	"""
+	The response returned by the KeepAliveHandler.
+
+	The body has already been read, which allows the connection
+	to be returned to the pool before the response is used.
+	"""
+
+	def __init__(self, body, headers, url, status, reason, truncated=False):
+		super().__init__(io.BytesIO(body), headers, url, status)
+		self.reason = reason
+
+		# urllib uses 'msg' for the reason phrase
+		self.msg = reason
+
+		# set if only a part of the body was read
+		self.truncated = truncated
+
+	def getheaders(self):
+		return self.headers.items()
+
+
+class KeepAliveHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+	"""
+	Replaces urllib's HTTP and HTTPS handlers, which open a new
+	connection (and do a new TLS handshake) for every request.
+	Connections are taken from and returned to a ConnectionPool.
+	"""
+
+	def __init__(self, pool, context=None, read_timeout=None, resolver=None):
+		urllib.request.AbstractHTTPHandler.__init__(self)
+		self.pool = pool
+		self._context = context
+
+		# the timeout of the request is used when connecting, and
+		# this one when waiting for the response
+		self.read_timeout = read_timeout
+
+		# the connections are made to the IPs cached by the resolver
+		self.resolver = resolver
+
+	def http_open(self, req):
+		return self._open(http.client.HTTPConnection, req)
+
+	def https_open(self, req):
+		return self._open(http.client.HTTPSConnection, req)
+
+	def _create_connection(self, connection_class, req, tunnel_headers):
+		if connection_class is http.client.HTTPSConnection:
+			connection = connection_class(req.host, timeout=req.timeout, context=self._context)
+		else:
+			connection = connection_class(req.host, timeout=req.timeout)
+
+		if self.resolver is not None:
+			connection._create_connection = self.resolver.create_connection
+
+		if req._tunnel_host:
+			connection.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+
+		return connection
+
+	def _open(self, connection_class, req):
+		if not req.host:
+			raise urllib.error.URLError('no host given')
+
+		headers = dict(req.unredirected_hdrs)
+		headers.update({k: v for k, v in req.headers.items() if k not in headers})
+		headers = {name.title(): value for name, value in headers.items()}
+
+		# the proxy authorization is sent when the tunnel is created
+		tunnel_headers = {}
+		if req._tunnel_host and 'Proxy-Authorization' in headers:
+			tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+		key = (connection_class.__name__, req.host, req._tunnel_host)
+		create = lambda: self._create_connection(connection_class, req, tunnel_headers)
+
+		# a reused connection might have been closed by the server.
+		# In that case the request is retried on a new connection
+		while True:
+			connection, reused = self.pool.get(key, create)
+			try:
+				connection.request(req.get_method(), req.selector, req.data, headers)
+				read_timeout = getattr(req, 'read_timeout', self.read_timeout)
+				if read_timeout is not None and connection.sock is not None:
+					connection.sock.settimeout(read_timeout)
+
+				response = connection.getresponse()
+				body, truncated = self._read_body(response, req)
+
+			except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as err:
+				connection.close()
+				if reused: continue
+				raise urllib.error.URLError(err)
+
+			except (OSError, http.client.HTTPException) as err:
+				connection.close()
+				raise urllib.error.URLError(err)
+
+			break
+
+		# the rest of a truncated body is still in the connection
+		if response.will_close or truncated:
+			connection.close()
+		else:
+			self.pool.put(key, connection)
+
+		return PooledResponse(body, response.msg, req.get_full_url(), response.status, response.reason, truncated)
+
+	def _read_body(self, response, req):
+		max_body = getattr(req, 'max_body', None)
+		patterns = getattr(req, 'patterns', None)
+		if max_body is None and not patterns:
+			return response.read(), False
+
+		reader = BodyReader(max_body, patterns)
+		while not response.isclosed():
+			chunk = response.read(reader.chunk_size)
+			if not chunk:
+				break
+
+			if reader.feed(chunk):
+				# the body is only truncated if some of it was not read
+				return reader.get_body(), reader.cut_off or self._has_unread(response)
+
+		return reader.get_body(), False
+
+	def _has_unread(self, response):
+		if response.isclosed():
+			return False
+
+		if response.length is not None:
+			return response.length > 0
+
+		# chunked, or read until the connection is closed
+		return response.read(1) != b''
+
+
 #######################################################################
 #
 # Custom request and response classes
@@ -143,24 +551,55 @@ class Response:
 
 	The normal http.client.HTTPResponse cannot be pickled
 	which is used in the caching process
+
+	The response keeps the raw body. The decoded body, and the
+	md5 sums used for error page detection, are computed when
+	they are first used. They are kept in '_derived', which the
+	cache shares between the responses with the same body, so
+	they are only computed and kept once per body.
 	"""
 
+	__slots__ = (
+		'url', 'protocol', 'host', 'status', 'headers', 'raw', 'md5',
+		'should_be_error_page', 'crawled_response', 'truncated', 'id',
+		'_body', '_derived'
+	)
+
+	# the attributes that are saved in the cache
+	_state = ('url', 'protocol', 'host', 'status', 'headers', 'raw', 'md5',
+		'should_be_error_page', 'crawled_response', 'truncated', 'id')
+
 	def __init__(self):
 		self.url = ''
 		self.protocol = ''
 		self.host = ''
 		self.status = {}
 		self.headers = {}
-		self.body = ''
+		self.raw = b''
 
 		self.md5 = None
-		self.md5_404 = None
 		self.should_be_error_page = False
 
 		self.crawled_response = False
 
-		chars = string.ascii_uppercase + string.digits
-		self.id = ''.join(random.choice(chars) for _ in range(16))
+		# set if only a part of the body was read
+		self.truncated = False
+
+		self.id = os.urandom(8).hex().upper()
+
+		self._body = None
+		self._derived = {}
+
+
+	def __getstate__(self):
+		return {key: getattr(self, key) for key in self._state}
+
+
+	def __setstate__(self, state):
+		self._body = None
+		self._derived = {}
+		for key in self._state:
+			setattr(self, key, state[key])
 
 
 	def get_url(self):
@@ -172,32 +611,62 @@ class Response:
 		return url_data.geturl()
 
 
-	def set_body(self, body):
-		# check if the encoding is specified in the http header
-		content_type = 'Content-Type'.lower()
+	def _get_charset(self):
+		# the charset in the content-type header, if any
+		for item in self.headers.get('content-type', '').split(';'):
+			name, _, value = item.partition('=')
+			if name.strip().lower() == 'charset':
+				return value.strip().strip('"\'') or None
 
-		if content_type not in self.headers:
-			self.body = str(body, errors='replace')
+		return None
+
+
+	def _decode(self, body):
+		# bodies are decoded as UTF-8, unless the http header
+		# specifies a charset python knows
+		charset = self._get_charset()
+		if charset is not None:
+			try:
+				return str(body, charset, errors='replace')
+			except LookupError:
+				pass
+
+		return str(body, 'utf-8', errors='replace')
+
+
+	@property
+	def body(self):
+		if self._body is None:
+			# the same body can be decoded differently
+			key = ('body', self._get_charset())
+			if key not in self._derived:
+				self._derived[key] = self._decode(self.raw)
+
+			self._body = self._derived[key]
+
+		return self._body
+
+
+	@property
+	def md5_404(self):
+		if 'md5_404' not in self._derived:
+			self._derived['md5_404'] = _clean_page(self.raw)
+
+		return self._derived['md5_404']
+
+
+	@property
+	def md5_404_text(self):
+		if 'md5_404_text' not in self._derived:
+			# get the page text only
+			parser = HTMLStripper()
+			parser.feed(self.raw.decode('utf-8', 'ignore'))
+			page_text = parser.get_tagtext()
+
+			self._derived['md5_404_text'] = _clean_page(page_text.encode('utf-8', 'ignore'))
+
+		return self._derived['md5_404_text']
 
-		else:
-			# find content-type definitions
-			content_types = {'text': False, 'charset': None}
-			
-			for item in self.headers[content_type].split(';'):
-				if 'text' in item:
-					content_types['text'] = True
-
-				if 'charset' in item:
-					content_types['charset'] = item.split('=')[1]
-
-			# set the encoding to use
-			if content_types['charset'] is not None:
-				self.body = str(body, content_types['charset'], errors='replace')
-			elif content_types['text']:
-				self.body = str(body, 'ISO-8859-1', errors='replace')
-			else:
-				self.body = str(body, errors='replace')
-		
 
 	def __repr__(self):
 		def get_string(r):
@@ -222,6 +691,7 @@ class Requester:
 		self.cache = data['cache']
 		self.requested = data['requested']
 		self.printer = data['printer']
+		self.resolver = data['resolver']
 
 		self.is_redirected = False
 		self.find_404s = False
@@ -232,8 +702,52 @@ class Requester:
 			self.url_data.path = options['prefix'] + self.url_data.path
 		self.url = urllib.request.urlunparse(self.url_data)
 
+		# keep-alive connections are shared by all the requests made
+		# by the requester, which means across all discovery phases
+		self.pool = ConnectionPool(self.threads)
+
+		self.connect_timeout = options['connect_timeout']
+		self.read_timeout = options['read_timeout']
+
+		# transient errors are retried, waiting 'backoff' seconds
+		# before the first retry, and twice as long for each next one
+		self.retries = options['retries']
+		self.backoff = 0.5
+
+		# the max size of a response body, and if the reading of bodies
+		# should stop when all the string fingerprints have been found
+		self.max_body = options['max_body']
+		self.early_stop = options['early_stop']
+
+		# the failed requests: run type -> kind of error -> count
+		self.failures = defaultdict(lambda: defaultdict(int))
+
+		# limit the requests per second (if set) and the number
+		# of requests in flight
+		self.rate_limiter = TokenBucket(options['rate']) if options['rate'] else None
+		self.controller = ConcurrencyController(self.threads)
+		self.openers = {}
+
+		# decides if 'HEAD' is used before 'GET'
+		self.head_policy = HeadPolicy()
+
+		# the executor is created on first use and reused by all runs
+		self.executor = None
+		self.lock = threading.Lock()
+
+		# the discovery phases can run at the same time, so two requests
+		# for the same url might be in flight. The second one waits for
+		# the first, and then uses the cached response
+		self.url_locks = defaultdict(threading.Lock)
+
 	def _create_fetcher(self, redirect_handler=True):
-		args = [ErrorHandler]
+		if redirect_handler not in self.openers:
+			self.openers[redirect_handler] = self._build_opener(redirect_handler)
+
+		return self.openers[redirect_handler]
+
+	def _build_opener(self, redirect_handler):
+		args = [ErrorHandler, KeepAliveHandler(self.pool, read_timeout=self.read_timeout, resolver=self.resolver)]
 		if self.proxy == None:
 			args.append(urllib.request.ProxyHandler({}))
 		elif not self.proxy == False:
@@ -256,7 +770,7 @@ class Requester:
 		# get an opener doing redirections 
 		try:
 			opener = self._create_fetcher(redirect_handler=False)
-			response = opener.open(self.url)
+			response = opener.open(self.url, timeout=self.connect_timeout)
 		except:
 			raise UnknownHostName(self.url)	
 
@@ -281,31 +795,69 @@ class Requester:
 
 		return (self.is_redirected, new_loc)
 
-	def do_request(self, url, run_type=None, method='GET'):
-		opener = self._create_fetcher()
-		request = urllib.request.Request(url, method=method)
-		response = opener.open(request)
-		R = _create_response(response)
-		
+	def _store_response(self, url, run_type, response, stale=None):
+		# a '304 Not Modified' means that the stale response is still valid
+		if stale is not None and response.code == 304:
+			R = stale
+		else:
+			R = _create_response(response)
+
 		if run_type == 'DiscoverMore':
-			R.crawled_response = True	
+			R.crawled_response = True
 
 		self.cache[url] = R
 		self.cache[response.geturl()] = R
 
-		return response
 
+	def _add_failure(self, run_type, err):
+		kind = _classify_error(err)
+		with self.lock:
+			self.failures[run_type][kind] += 1
 
-	def request(self, fp_list, run_type):
-		url = fp_list[0]['url']
-		complete_url = urllib.parse.urljoin(self.url, url)
+		self.printer.print_debug_line('- Request failed (%s): %s' % (kind, err), 3)
 
-		R = None
 
-		# check if the url is out of scope
-		url_data = urllib.parse.urlparse(complete_url)
-		host_data = urllib.parse.urlparse(self.url)
-		
+	def get_failures(self):
+		with self.lock:
+			return {run_type: dict(kinds) for run_type, kinds in self.failures.items()}
+
+
+	def do_request(self, url, run_type=None, method='GET', stale=None, patterns=None):
+		# retry transient errors, waiting longer after each attempt
+		for attempt in range(self.retries + 1):
+			try:
+				return self._do_request(url, run_type, method, stale, patterns)
+			except Exception as err:
+				if attempt == self.retries or _classify_error(err) not in TRANSIENT_ERRORS:
+					raise
+
+			time.sleep(self.backoff * 2 ** attempt)
+
+
+	def _do_request(self, url, run_type, method, stale, patterns):
+		opener = self._create_fetcher()
+		request = urllib.request.Request(url, headers=self._get_validators(stale), method=method)
+		request.max_body = self.max_body
+		request.patterns = patterns
+
+		self.controller.acquire()
+		if self.rate_limiter is not None:
+			time.sleep(self.rate_limiter.reserve())
+
+		start = time.monotonic()
+		try:
+			response = opener.open(request, timeout=self.connect_timeout)
+		except Exception as err:
+			self.controller.release(congested=_is_timeout(err))
+			raise
+
+		self.controller.release(time.monotonic() - start, response.code in CONGESTION_CODES)
+		self._store_response(url, run_type, response, stale)
+
+		return response
+
+
+	def _can_use_head(self, fp_list):
 		# check if it is possible to use 'HEAD' instead of 'GET'
 		# this should be possible for all fingerprints, that do not
 		# have a specified a 'code' or 'code' is '200'.
@@ -316,41 +868,514 @@ class Requester:
 			if 'code' in fp and (fp['code'] == 'any' or fp['code'] != 200):
 				can_use_head = False
 
-		if not url_data.netloc == host_data.netloc:
-			pass
+		return can_use_head
+
+
+	def _is_found(self, head, response):
+		# the response to 'GET' is used, unless both 'HEAD' and 'GET'
+		# report the resource as missing. In that case 'GET' was only
+		# used to check that 'HEAD' can be trusted
+		if head is None:
+			return True
+
+		self.head_policy.add_result(head.code, response.code)
+		return head.code == 200 or response.code == 200
+
+
+	def _get_validators(self, stale):
+		# the headers used to check if a cached response is still valid
+		headers = {}
+		if stale is not None:
+			if 'etag' in stale.headers:
+				headers['If-None-Match'] = stale.headers['etag']
+			if 'last-modified' in stale.headers:
+				headers['If-Modified-Since'] = stale.headers['last-modified']
+
+		return headers
+
+
+	def _get_stale(self, complete_url):
+		# an expired response from the persisted cache can be
+		# revalidated, if it has an etag or a modification date
+		stale = self.cache.get_stale(complete_url)
+		if stale is not None and self._get_validators(stale):
+			return stale
+
+		return None
+
+
+	def _get_patterns(self, fp_list):
+		# if all the fingerprints are strings, the reading of the body
+		# can stop once all of them have been found
+		if not self.early_stop:
+			return None
+
+		if not all(fp.get('type') == 'string' and fp.get('match') for fp in fp_list):
+			return None
+
+		return [fp['match'].encode('utf-8') for fp in fp_list]
+
+
+	def _is_incomplete(self, response, patterns):
+		# a partly read response can be used, if all the
+		# strings searched for are in the part that was read
+		if response is None or not response.truncated:
+			return False
+
+		return patterns is None or not all(pattern in response.raw for pattern in patterns)
+
+
+	def _is_in_scope(self, complete_url):
+		url_data = urllib.parse.urlparse(complete_url)
+		host_data = urllib.parse.urlparse(self.url)
+
+		return url_data.netloc == host_data.netloc
+
+
+	def _get_url_lock(self, url):
+		with self.lock:
+			return self.url_locks[url]
+
+
+	def request(self, fp_list, run_type):
+		url = fp_list[0]['url']
+		complete_url = urllib.parse.urljoin(self.url, url)
+
+		R = None
+		can_use_head = self._can_use_head(fp_list)
+
+		# check if the url is out of scope
+		if not self._is_in_scope(complete_url):
+			return (fp_list, R)
+
+		patterns = self._get_patterns(fp_list)
+
+		with self._get_url_lock(complete_url):
+			cached = self.cache.get(complete_url)
+			if cached is None or self._is_incomplete(cached, patterns):
+				try:
+					# an expired response is revalidated with a conditional 'GET'
+					stale = self._get_stale(complete_url) if cached is None else None
+
+					# if it is possible to use 'HEAD', use it. If the result is 
+					# a '200', request the resource with a 'GET'
+					head = None
+					get_resource = True
+					if can_use_head and cached is None and stale is None and self.head_policy.use_head():
+						head = self.do_request(complete_url, run_type, method='HEAD')
+						get_resource = self.head_policy.should_get(head.code)
+
+					# Fetch the ressource if the resource exists or 
+					# if the fingerprint requires any response
+					if get_resource:
+						response = self.do_request(complete_url, run_type, 'GET', stale, patterns)
+						if self._is_found(head, response):
+							R = self.cache[complete_url]
+				
+				except Exception as err:
+					self._add_failure(run_type, err)
+			else:
+				R = cached
+
+		return (fp_list, R)
+
+
+	def fetch(self, url, timeout=None):
+		"""
+		Requests 'url' with a 'GET', and returns the response. The url
+		does not have to be on the scanned host, and the cache is not
+		used, so the response cannot affect the fingerprint matching
+		"""
+		opener = self._create_fetcher(redirect_handler=False)
+		request = urllib.request.Request(url, method='GET')
+		request.max_body = self.max_body
+		request.read_timeout = timeout or self.read_timeout
+
+		if self.rate_limiter is not None:
+			time.sleep(self.rate_limiter.reserve())
+
+		response = opener.open(request, timeout=timeout or self.connect_timeout)
+		return _create_response(response)
+
+
+	def submit(self, fp_list, run_type=None):
+		"""
+		Schedule the request of a fingerprint list. Returns a
+		concurrent.futures.Future with the result of request()
+		"""
+		with self.lock:
+			if self.executor is None:
+				self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+
+		return self.executor.submit(self.request, fp_list, run_type)
+
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+		self.pool.close()
+
+
+	def stream(self, run_type=None, fp_lists=[]):
+		"""
+		Request the fingerprint lists, and yield the results of
+		request() as soon as they are done, which allows the
+		responses to be matched while the rest are requested
+		"""
+		future_list = [self.submit(fp_list, run_type) for fp_list in fp_lists]
+
+		for future in concurrent.futures.as_completed(future_list):
+			yield future.result()
+
+
+	def run(self, run_type=None, fp_lists=[]):
+		for result in self.stream(run_type, fp_lists):
+			self.requested.put(result)
+
+		return self.requested
+
+
+class AsyncConnection(object):
+	def __init__(self, reader, writer):
+		self.reader = reader
+		self.writer = writer
+
+	def close(self):
+		self.writer.close()
+
+
+class AsyncRequester(Requester):
+	"""
+	Requester using asyncio instead of threads.
+
+	The requests are run on an event loop in a background thread, which
+	allows for many more concurrent requests than a thread pool. At most
+	options['concurrency'] requests are in flight at a time, and the
+	concurrency controller lowers this if the host is slow or overloaded. The HTTP
+	client is a minimal HTTP/1.1 implementation with keep-alive support.
+	At most options['host_connections'] connections are used per host,
+	as small servers drop the connections they cannot accept right away.
+
+	The contract of run() is the same as for Requester. Proxies are not
+	supported by this requester.
+	"""
+
+	def __init__(self, options, data):
+		super().__init__(options, data)
+		self.concurrency = options['concurrency']
+		self.max_redirects = urllib.request.HTTPRedirectHandler.max_redirections
+
+		self.pool = ConnectionPool(self.concurrency)
+		self.controller = ConcurrencyController(self.concurrency)
+		self.ssl_context = ssl.create_default_context()
+
+		# a request holds a slot of its host while it uses a
+		# connection, so the number of connections is limited
+		self.host_connections = options['host_connections']
+		self.host_slots = defaultdict(lambda: asyncio.Semaphore(self.host_connections))
 
-		elif not complete_url in self.cache:
+		# created in the event loop on first use. Set when a
+		# request is done, and a new one can be started
+		self.slot_freed = None
+		self.url_locks = defaultdict(asyncio.Lock)
+
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self.thread.start()
+
+
+	async def _connect(self, scheme, host, port):
+		ssl_context = self.ssl_context if scheme == 'https' else None
+		server_hostname = host if ssl_context is not None else None
+
+		# connect to the IPs cached by the resolver. The host name
+		# is still used to verify the certificate
+		try:
+			ips = await self.loop.run_in_executor(None, self.resolver.resolve, host)
+		except socket.gaierror:
+			ips = [host]
+
+		error = None
+		for ip in ips:
+			connect = asyncio.open_connection(ip, port, ssl=ssl_context, server_hostname=server_hostname)
 			try:
-				# if it is possible to use 'HEAD', use it. If the result is 
-				# a '200', request the resource with a 'GET'
-				get_resource = True
-				if can_use_head:
-					response = self.do_request(complete_url, run_type, method='HEAD')
-					if not response.code == 200:
-						get_resource = False
-
-				# Fetch the ressource if the resource exists or 
-				# if the fingerprint requires any response
-				if get_resource:
-					self.do_request(complete_url, run_type, method='GET')
-					R = self.cache[complete_url]
-			
-			except Exception as e:
+				reader, writer = await asyncio.wait_for(connect, self.connect_timeout)
+				return AsyncConnection(reader, writer)
+			except OSError as err:
+				error = err
+
+		raise error
+
+
+	async def _read_response(self, reader, method, max_body=None, patterns=None):
+		status_line = await reader.readline()
+		if not status_line:
+			raise http.client.RemoteDisconnected('Remote end closed connection without response')
+
+		version, status, reason = (status_line.decode('iso-8859-1').strip().split(None, 2) + [''])[:3]
+		status = int(status)
+
+		header_lines = []
+		while True:
+			line = await reader.readline()
+			header_lines.append(line)
+			if line in (b'\r\n', b'\n', b''):
+				break
+
+		headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+		keep_alive = version == 'HTTP/1.1' and not 'close' in headers.get('connection', '').lower()
+
+		# read the body
+		body = BodyReader(max_body, patterns)
+		truncated = False
+
+		if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+			pass
+
+		elif 'chunked' in headers.get('transfer-encoding', '').lower():
+			stopped = False
+			while True:
+				size = int((await reader.readline()).split(b';')[0].strip(), 16)
+				if size == 0:
+					break
+
+				# the body is only truncated if a chunk is left
+				if stopped:
+					truncated = True
+					break
+
+				stopped = body.feed(await reader.readexactly(size))
+				await reader.readline()
+
+			# skip the trailer
+			while not truncated and (await reader.readline()) not in (b'\r\n', b'\n', b''):
 				pass
+
+		elif headers.get('content-length') is not None:
+			remaining = int(headers['content-length'])
+			while remaining > 0:
+				chunk = await reader.read(min(remaining, body.chunk_size))
+				if not chunk:
+					raise asyncio.IncompleteReadError(body.get_body(), remaining)
+
+				remaining -= len(chunk)
+				if body.feed(chunk):
+					truncated = body.cut_off or remaining > 0
+					break
+
 		else:
-			R = self.cache[complete_url]
+			while True:
+				chunk = await reader.read(body.chunk_size)
+				if not chunk:
+					break
+
+				if body.feed(chunk):
+					truncated = body.cut_off or (await reader.read(1)) != b''
+					break
+
+			keep_alive = False
+
+		truncated = truncated or body.cut_off
+
+		# the rest of a truncated body is still in the connection
+		keep_alive = keep_alive and not truncated
+
+		return status, reason, headers, body.get_body(), keep_alive, truncated
+
+
+	async def _send(self, url, method, extra_headers, patterns):
+		url_data = urllib.parse.urlsplit(url)
+		netloc = url_data.netloc.rsplit('@', 1)[-1]
+		port = url_data.port or (443 if url_data.scheme == 'https' else 80)
+
+		selector = url_data.path or '/'
+		if url_data.query:
+			selector += '?' + url_data.query
+
+		request = '\r\n'.join([
+			'%s %s HTTP/1.1' % (method, selector),
+			'Host: %s' % (netloc, ),
+			'User-Agent: %s' % (self.user_agent, ),
+			'Accept-Encoding: identity',
+			'Connection: keep-alive'
+		] + ['%s: %s' % header for header in extra_headers.items()] + [
+			'', ''
+		]).encode('ascii')
+
+		key = (url_data.scheme, netloc)
+
+		async with self.host_slots[key]:
+			# a reused connection might have been closed by the server.
+			# In that case the request is retried on a new connection
+			while True:
+				connection, reused = self.pool.get(key, lambda: None)
+				if connection is None:
+					connection = await self._connect(url_data.scheme, url_data.hostname, port)
+
+				try:
+					connection.writer.write(request)
+					await connection.writer.drain()
+					read = self._read_response(connection.reader, method, self.max_body, patterns)
+					status, reason, headers, body, keep_alive, truncated = await asyncio.wait_for(read, self.read_timeout)
+
+				except (ConnectionError, asyncio.IncompleteReadError) as err:
+					connection.close()
+					if reused: continue
+					raise urllib.error.URLError(err)
+
+				except Exception:
+					connection.close()
+					raise
+
+				break
+
+			if keep_alive:
+				self.pool.put(key, connection)
+			else:
+				connection.close()
+
+		return PooledResponse(body, headers, url, status, reason, truncated)
+
+
+	async def _fetch(self, url, method, headers, patterns, scoped=True):
+		# follow redirections within the scope of the host
+		for _ in range(self.max_redirects + 1):
+			response = await self._send(url, method, headers, patterns)
+
+			if response.code in (301, 302, 303, 307, 308) and 'location' in response.headers:
+				location = response.headers['location']
+				if scoped:
+					check_redirect_scope(url, location)
+				url = urllib.parse.urljoin(url, location)
+			else:
+				return response
+
+		raise urllib.error.URLError('Too many redirections: %s' % (url, ))
+
+
+	async def _acquire(self):
+		if self.slot_freed is None:
+			self.slot_freed = asyncio.Event()
+
+		# the controller is only used from the event loop, so a
+		# slot cannot be freed between the check and the wait
+		while not self.controller.try_acquire():
+			self.slot_freed.clear()
+			await self.slot_freed.wait()
+
+		if self.rate_limiter is not None:
+			await asyncio.sleep(self.rate_limiter.reserve())
+
+
+	def _release(self, latency=None, congested=False):
+		self.controller.release(latency, congested)
+		self.slot_freed.set()
+
+
+	async def do_request_async(self, url, run_type=None, method='GET', stale=None, patterns=None):
+		# retry transient errors, waiting longer after each attempt
+		for attempt in range(self.retries + 1):
+			try:
+				return await self._do_request_async(url, run_type, method, stale, patterns)
+			except Exception as err:
+				if attempt == self.retries or _classify_error(err) not in TRANSIENT_ERRORS:
+					raise
+
+			await asyncio.sleep(self.backoff * 2 ** attempt)
+
+
+	async def _do_request_async(self, url, run_type, method, stale, patterns):
+		await self._acquire()
+
+		start = time.monotonic()
+		try:
+			response = await self._fetch(url, method, self._get_validators(stale), patterns)
+		except Exception as err:
+			self._release(congested=_is_timeout(err))
+			raise
+
+		self._release(time.monotonic() - start, response.code in CONGESTION_CODES)
+		self._store_response(url, run_type, response, stale)
+
+		return response
+
+
+	async def request_async(self, fp_list, run_type):
+		url = fp_list[0]['url']
+		complete_url = urllib.parse.urljoin(self.url, url)
+
+		R = None
+		can_use_head = self._can_use_head(fp_list)
+
+		# check if the url is out of scope
+		if not self._is_in_scope(complete_url):
+			return (fp_list, R)
+
+		patterns = self._get_patterns(fp_list)
+
+		# the locks are only used in the event loop
+		async with self.url_locks[complete_url]:
+			cached = self.cache.get(complete_url)
+			if cached is None or self._is_incomplete(cached, patterns):
+				try:
+					# an expired response is revalidated with a conditional 'GET'
+					stale = self._get_stale(complete_url) if cached is None else None
+
+					# if it is possible to use 'HEAD', use it. If the result is
+					# a '200', request the resource with a 'GET'
+					head = None
+					get_resource = True
+					if can_use_head and cached is None and stale is None and self.head_policy.use_head():
+						head = await self.do_request_async(complete_url, run_type, method='HEAD')
+						get_resource = self.head_policy.should_get(head.code)
+
+					# Fetch the ressource if the resource exists or
+					# if the fingerprint requires any response
+					if get_resource:
+						response = await self.do_request_async(complete_url, run_type, 'GET', stale, patterns)
+						if self._is_found(head, response):
+							R = self.cache[complete_url]
+
+				except Exception as err:
+					self._add_failure(run_type, err)
+			else:
+				R = cached
 
 		return (fp_list, R)
 
 
-	def run(self, run_type=None, fp_lists=[]):
-		with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
-			future_list = []
+	async def _fetch_page(self, url, timeout):
+		if self.rate_limiter is not None:
+			await asyncio.sleep(self.rate_limiter.reserve())
 
-			for fp_list in fp_lists:
-				future_list.append(executor.submit(self.request, fp_list, run_type))
-				
-			for future in concurrent.futures.as_completed(future_list):
-				self.requested.put(future.result())
+		# the connect and read timeouts still apply without 'timeout'
+		fetch = self._fetch(url, 'GET', {}, None, scoped=False)
+		return _create_response(await asyncio.wait_for(fetch, timeout))
+
+
+	def fetch(self, url, timeout=None):
+		return asyncio.run_coroutine_threadsafe(self._fetch_page(url, timeout), self.loop).result()
+
+
+	def submit(self, fp_list, run_type=None):
+		return asyncio.run_coroutine_threadsafe(self.request_async(fp_list, run_type), self.loop)
+
+
+	async def _close_connections(self):
+		self.pool.close()
+
+		# let the transports finish closing before the loop is stopped
+		await asyncio.sleep(0)
+
+
+	def close(self):
+		if self.loop.is_closed():
+			return
 
-		return self.requested
\ No newline at end of file
+		# the connections must be closed from within the event loop
+		asyncio.run_coroutine_threadsafe(self._close_connections(), self.loop).result()
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.close()
\ No newline at end of file
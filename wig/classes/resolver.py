@@ -0,0 +1,132 @@
+"""
+Caching of DNS lookups.
+
+"""
+
+import socket
+import threading
+import time
+
+
+class Resolver(object):
+	"""
+	Resolves host names and caches the results.
+
+	The resolver is shared by all the scans of a process, and by all
+	the connections they make, so a name is only looked up once while
+	its result is cached. Successful lookups are cached for 'ttl'
+	seconds, and failed lookups for 'negative_ttl' seconds. At most
+	'max_size' names are cached, the oldest are dropped first.
+	Concurrent lookups of the same name wait for the first one.
+	"""
+
+	def __init__(self, ttl=300, negative_ttl=60, max_size=10000):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.max_size = max_size
+
+		# name -> (expires, list of ips or the error raised), in the
+		# order the names were looked up
+		self.cache = {}
+		self.lock = threading.Lock()
+
+		# the locks of the names that are being looked up
+		self.name_locks = {}
+
+		self.hits = 0
+		self.misses = 0
+
+	def _get_cached(self, name):
+		with self.lock:
+			entry = self.cache.get(name)
+			if entry is None:
+				return None
+
+			if entry[0] <= time.monotonic():
+				del self.cache[name]
+				return None
+
+			self.hits += 1
+			return entry[1]
+
+	def _lookup(self, name):
+		try:
+			return socket.gethostbyname_ex(name)[2], self.ttl
+		except (socket.gaierror, socket.herror, UnicodeError) as err:
+			return err, self.negative_ttl
+
+	def _add(self, name, expires, result):
+		with self.lock:
+			self.misses += 1
+
+			# drop the oldest names to make room
+			while len(self.cache) >= self.max_size:
+				del self.cache[next(iter(self.cache))]
+
+			self.cache[name] = (expires, result)
+
+	def resolve(self, name):
+		"""
+		Returns the list of IPs of 'name'. Raises socket.gaierror
+		if the name cannot be resolved
+		"""
+		result = self._get_cached(name)
+		if result is None:
+			with self.lock:
+				name_lock = self.name_locks.setdefault(name, threading.Lock())
+
+			with name_lock:
+				result = self._get_cached(name)
+				if result is None:
+					result, ttl = self._lookup(name)
+					self._add(name, time.monotonic() + ttl, result)
+
+			# the waiting lookups find the result in the cache, so
+			# the lock is not needed anymore
+			with self.lock:
+				if self.name_locks.get(name) is name_lock:
+					del self.name_locks[name]
+
+		if isinstance(result, Exception):
+			raise result
+
+		return list(result)
+
+	def create_connection(self, address, timeout, source_address=None):
+		"""
+		Same as socket.create_connection(), but connects to the cached
+		IPs of the host, so the IPs reported for a host are the ones
+		connected to. Names the resolver cannot resolve, e.g. hosts
+		with only IPv6 addresses, are left to the system resolver
+		"""
+		host, port = address
+		try:
+			ips = self.resolve(host)
+		except socket.gaierror:
+			return socket.create_connection(address, timeout, source_address)
+
+		if not ips:
+			raise socket.gaierror('No addresses found for: %s' % (host, ))
+
+		error = None
+		for ip in ips:
+			try:
+				return socket.create_connection((ip, port), timeout, source_address)
+			except OSError as err:
+				error = err
+
+		raise error
+
+	def get_stats(self, since=None):
+		"""
+		Returns the number of cached and looked up names. If 'since'
+		is the result of an earlier call, only the lookups made after
+		that call are counted
+		"""
+		with self.lock:
+			stats = {'hits': self.hits, 'misses': self.misses}
+
+		if since is not None:
+			stats = {key: value - since[key] for key, value in stats.items()}
+
+		return stats
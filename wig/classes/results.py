@@ -1,8 +1,93 @@
+import array
+import threading
 from collections import defaultdict, Counter, namedtuple
 
 from wig.classes.sitemap import Sitemap
 
 
+# the types of the results. The name of the type is used
+# to tell the results apart in the output
+CMS = namedtuple('CMS', ['name', 'version'])
+Platform = namedtuple('Platform', ['name', 'version'])
+JavaScript = namedtuple('JavaScript', ['name', 'version'])
+OS = namedtuple('OS', ['name', 'version'])
+Vulnerability = namedtuple('Vulnerability', ['software', 'version', 'num_vuln', 'link'])
+Tool = namedtuple('Tool', ['software', 'tool_name', 'link'])
+Subdomain = namedtuple('Subdomain', ['subdomain', 'page_title', 'ip'])
+Interesting = namedtuple('Interesting', ['note', 'url'])
+PlatformNote = namedtuple('PlatformNote', ['platform', 'url'])
+
+VERSION_TYPES = {'cms': CMS, 'platform': Platform, 'js': JavaScript, 'os': OS}
+
+
+class ScoreTable(object):
+	"""
+	The scores of the versions of a single CMS, platform, etc.
+
+	Each version is stored once, and its score is kept in an array at
+	the index of the version, so a score is updated with a dict lookup.
+	The best versions can be read at any time during the scan.
+
+	md5 fingerprints are based on content that might not have been
+	changed across different versions. The score of an md5 match is
+	therefore 1 / the number of 'hits' for the url, which is only known
+	when all matches are in. The md5 matches are kept per url, and their
+	scores are added when the scores are read.
+	"""
+
+	__slots__ = ('index', 'versions', 'scores', 'md5_matches')
+
+	def __init__(self):
+		self.index = {}
+		self.versions = []
+		self.scores = array.array('d')
+
+		# the number of the url -> Counter of versions
+		self.md5_matches = {}
+
+	def _intern(self, version):
+		i = self.index.get(version)
+		if i is None:
+			i = self.index[version] = len(self.versions)
+			self.versions.append(version)
+			self.scores.append(0)
+
+		return i
+
+	def add(self, version, weight):
+		self.scores[self._intern(version)] += weight
+
+	def add_md5(self, url_number, version):
+		# the urls are numbered in the order they were first matched,
+		# and the md5 scores are added in that order
+		self.md5_matches.setdefault(url_number, Counter())[version] += 1
+
+	def get_md5_matches(self):
+		return [self.md5_matches[key] for key in sorted(self.md5_matches)]
+
+	def get_scores(self):
+		scores = dict(zip(self.versions, self.scores))
+		for versions in self.get_md5_matches():
+			number_of_hits = sum(versions.values())
+			for version in versions:
+				scores[version] = scores.get(version, 0) + 1 / number_of_hits
+
+		return list(scores.items())
+
+	def get_best(self):
+		"""
+		Returns the versions with the highest score. A blank version is
+		only returned if there are no other versions
+		"""
+		versions = sorted(self.get_scores(), key=lambda x:x[1], reverse=True)
+
+		# if the highest rated version is blank, move it to the end of the list
+		if versions[0][0] == '':
+			versions = versions[1:] + [versions[0]]
+
+		return sorted(i[0] for i in versions if i[1] == versions[0][1])
+
+
 class Results(object):
 
 	def __init__(self, options):
@@ -10,19 +95,18 @@ class Results(object):
 		self.printer = None
 		self.results = []
 
-		# the storage for 'string' and 'regex' matched fingerprints
-		# since these don't need extra processing they are added directly
-		# to the final scores
-		self.scores = defaultdict(lambda: defaultdict(lambda: Counter()))
-		#		      ^ Category          ^ Name              ^ Version
+		# used to check if a result has been added already
+		self.result_set = set()
+
+		# the discovery phases can add results at the same time
+		self.lock = threading.RLock()
+
+		# the scores of the versions
+		self.scores = defaultdict(dict)
+		#		      ^ Category  ^ Name -> ScoreTable
 
-		# md5 fingerprints are based on content that might not hav been changed
-		# across different versions of the cms. The score of a match is based on
-		# the number of 'hits' for that URL. The finale score for a cms version will be:
-		#  1 / number_of_hits
-		#
-		self.md5_matches = defaultdict(lambda: defaultdict(lambda: Counter()))
-		#		           ^ Url               ^ cms               ^ versions
+		# the numbers of the urls with md5 matches, see ScoreTable.add_md5()
+		self.md5_urls = {}
 
 		self.platform_observations = defaultdict(lambda: defaultdict(set))
 
@@ -36,22 +120,25 @@ class Results(object):
 			'subdomains': set(),
 		}
 
-	def _calc_md5_score(self):
-		# calculate the final scores for md5 fingerprints, and add
-		# them to the final scores
-		for url in self.md5_matches:
-			for cat_name in self.md5_matches[url]:
-				category, name = cat_name
+	def _get_table(self, category, name):
+		table = self.scores[category].get(name)
+		if table is None:
+			table = self.scores[category][name] = ScoreTable()
 
-				# get the number of 'hits' for a specific CMS and URL
-				number_of_hits = sum([self.md5_matches[url][cat_name][version] for version in self.md5_matches[url][cat_name]])
+		return table
 
-				# update the score for the cms version
-				for version in self.md5_matches[url][cat_name]:
-					self.scores[category][name][version] += (1 / number_of_hits)
+
+	def _add_result(self, result):
+		self.results.append(result)
+		self.result_set.add(result)
 
 
 	def add_version(self, category, name, version=None, fingerprint=None, weight=1):
+		with self.lock:
+			self._add_version(category, name, version, fingerprint, weight)
+
+
+	def _add_version(self, category, name, version, fingerprint, weight):
 		url = ''
 		match_type = ''
 
@@ -87,7 +174,8 @@ class Results(object):
 		# the a given URL, as this determines the weight score of
 		# fingerprint match
 		if match_type == 'md5':
-			self.md5_matches[url][(category, name)][version] += 1
+			url_number = self.md5_urls.setdefault(url, len(self.md5_urls))
+			self._get_table(category, name).add_md5(url_number, version)
 
 		# if there has been no version detection (interesting file discovery)
 		# skip adding the versions to the scores
@@ -97,39 +185,39 @@ class Results(object):
 		# if the version is blank or true, add '0' to
 		# set it to the worst match
 		elif version == '' or version == True:
-			self.scores[category][name][version] += 0
+			self._get_table(category, name).add(version, 0)
 
 		# else add the weight
 		else:
-			self.scores[category][name][version] += weight
+			self._get_table(category, name).add(version, weight)
 
 
 
-	def update(self):
-		self._calc_md5_score()
+	def get_best_versions(self, category, name):
+		"""
+		Returns the most likely versions of 'name' found so far
+		"""
+		with self.lock:
+			table = self.scores.get(category, {}).get(name)
+			return table.get_best() if table is not None else []
 
-		c = {
-			'cms': namedtuple('CMS', ['name', 'version']),
-			'platform': namedtuple('Platform', ['name', 'version']),
-			'js': namedtuple('JavaScript', ['name', 'version']),
-			'os': namedtuple('OS', ['name', 'version'])
-		}
 
+	def get_md5_matches(self, category, name):
+		"""
+		Returns the versions matched by md5 fingerprints for
+		'name', as a Counter per url
+		"""
+		with self.lock:
+			table = self.scores.get(category, {}).get(name)
+			return table.get_md5_matches() if table is not None else []
+
+
+	def update(self):
 		for category in self.scores:
 			# loop over the entries for the category
 			for name in sorted(self.scores[category]):
-
-				# get the versions and remove the ones that are most unlikely
-				v = self.scores[category][name]
-				versions = sorted(v.items(), key=lambda x:x[1], reverse=True)
-
-				# if the highest rated version is blank, move it to the end of the list
-				if versions[0][0] == '':
-					versions = versions[1:] + [versions[0]]
-
-				relevant = sorted(i[0] for i in versions if i[1] == versions[0][1])
-				for version in relevant:
-					self.results.append(c[category](name, version))
+				for version in self.scores[category][name].get_best():
+					self._add_result(VERSION_TYPES[category](name, version))
 
 		# check if there are multiple precise version detection of the same platform
 		platforms = self.platform_observations
@@ -142,30 +230,25 @@ class Results(object):
 
 
 	def add_vulnerabilities(self, cms, version, num_vuln, link):
-		Vulnerability = namedtuple('Vulnerability', ['software', 'version', 'num_vuln', 'link'])
-		self.results.append(Vulnerability(cms, version, num_vuln, link))
+		self._add_result(Vulnerability(cms, version, num_vuln, link))
 
 
 	def add_tool(self, cms, tool_name, tool_link):
-		Tool = namedtuple('Tool', ['software', 'tool_name', 'link'])
-		self.results.append(Tool(cms, tool_name, tool_link))
+		self._add_result(Tool(cms, tool_name, tool_link))
 
 
 	def add_subdomain(self, subdomain, title, ip):
-		Subdomain = namedtuple('Subdomain', ['subdomain', 'page_title', 'ip'])
-		self.results.append(Subdomain(subdomain, title, ip))
+		self._add_result(Subdomain(subdomain, title, ip))
 
 
 	def add_interesting(self, note, url):
-		Interesting = namedtuple('Interesting', ['note', 'url'])
-
-		if not Interesting(note, url) in self.results:
-			self.results.append(Interesting(note, url))
+		with self.lock:
+			if not Interesting(note, url) in self.result_set:
+				self._add_result(Interesting(note, url))
 
 
 	def add_platform_note(self, platform, url):
-		PlatformNote = namedtuple('PlatformNote', ['platform', 'url'])
-		self.results.append(PlatformNote(platform, url))
+		self._add_result(PlatformNote(platform, url))
 
 
 	def get_sitemap(self):
@@ -173,4 +256,6 @@ class Results(object):
 
 
 	def get_platform_results(self):
-		return self.scores['platform']
+		# returns the versions found for each platform
+		with self.lock:
+			return {name: list(table.versions) for name, table in self.scores['platform'].items() if table.versions}
@@ -26,6 +26,7 @@ and version.
 """
 
 import argparse
+import concurrent.futures, contextlib, copy, io, multiprocessing
 import time, queue, sys
 from wig.classes.cache import Cache
 from wig.classes.results import Results
@@ -34,21 +35,69 @@ from wig.classes.discovery import *
 from wig.classes.matcher import Match
 from wig.classes.printer import Printer
 from wig.classes.output import OutputPrinter, OutputJSON
-from wig.classes.request2 import Requester, UnknownHostName
+from wig.classes.resolver import Resolver
+from wig.classes.request2 import Requester, AsyncRequester, UnknownHostName
 
 
 
+def read_urls(file_name):
+	# the urls are read one at a time, to avoid keeping
+	# very long lists of urls in memory
+	with open(file_name, 'r') as input_file:
+		for url in input_file:
+			url = url.strip()
+			if url == '': continue
+			yield url if '://' in url else 'http://'+url
+
+
+# the Wig instance of a worker process, see Wig.run_parallel()
+_worker = None
+
+def _init_worker(args):
+	global _worker
+
+	# the results are written by the main process
+	args = copy.copy(args)
+	args.workers = 1
+	args.json_lines = False
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		_worker = Wig(args)
+
+def _scan_worker(url):
+	# the output of the scan is captured and returned, so the
+	# main process can print the output of each site in one go
+	output = io.StringIO()
+	with contextlib.redirect_stdout(output):
+		_worker.reset()
+		_worker.options['url'] = url
+		try:
+			_worker.scan_site()
+		except Exception as err:
+			# a site that fails does not stop the scan of the others
+			_worker.data['printer'].print_debug_line('Error scanning %s: %s' % (url, err), 0)
+			if _worker.options['write_file'] is not None:
+				_worker.json_outputter.add_error(str(err))
+
+			if 'requester' in _worker.data:
+				_worker.data['requester'].close()
+
+	sites = []
+	if _worker.options['write_file'] is not None:
+		sites = list(_worker.json_outputter.json_data)
+		_worker.json_outputter.json_data.clear()
+
+	return output.getvalue(), sites
+
+
 class Wig(object):
 	def __init__(self, args):
+		self.args = args
+
 		urls = None
 		if args.input_file is not None:
 			args.quiet = True
-
-			with open(args.input_file, 'r') as input_file:
-				urls = []
-				for url in input_file.readlines():
-					url = url.strip()
-					urls.append(url if '://' in url else 'http://'+url)
+			urls = read_urls(args.input_file)
 
 		else:
 			args.url = args.url.lower()
@@ -56,10 +105,6 @@ class Wig(object):
 				args.url = 'http://' + args.url
 
 		text_printer = Printer(args.verbosity)
-		cache = Cache()
-		cache.set_location(args.cache_dir)
-
-		cache.printer = text_printer
 
 		self.options = {
 			'url': args.url,
@@ -69,28 +114,47 @@ class Wig(object):
 			'user_agent': args.user_agent,
 			'proxy': args.proxy,
 			'verbosity': args.verbosity,
-			'threads': 10,
+			'threads': args.threads,
+			'rate': args.rate,
+			'connect_timeout': args.connect_timeout,
+			'read_timeout': args.read_timeout,
+			'retries': args.retries,
+			'max_body': int(args.max_body * 1024 * 1024) if args.max_body else None,
+			'early_stop': args.early_stop,
+			'engine': args.engine,
+			'concurrency': args.concurrency,
+			'host_connections': args.host_connections,
 			'batch_size': 20,
+			'version_batch_size': 4,
 			'run_all': args.run_all,
 			'match_all': args.match_all,
 			'stop_after': args.stop_after,
+			'adaptive_version': args.adaptive_version,
+			'version_confidence': args.version_confidence,
 			'no_cache_load': args.no_cache_load,
 			'no_cache_save': args.no_cache_save,
 			'write_file': args.output_file,
+			'json_lines': args.json_lines or args.workers > 1,
+			'workers': args.workers,
+			'cache_dir': args.cache_dir,
 			'subdomains': args.subdomains
 		}
 
 		self.data = {
-			'cache': cache,
+			'cache': None,
 			'results': Results(self.options),
 			'fingerprints': Fingerprints(),
 			'matcher': Match(),
 			'printer': text_printer,
 			'detected_cms': set(),
 			'error_pages': set(),
-			'requested': queue.Queue()
+			'requested': queue.Queue(),
+			'resolver': Resolver(),
+			'wildcards': {}
 		}
 
+		self.data['cache'] = self.create_cache()
+
 		if self.options['write_file'] is not None:
 			self.json_outputter = OutputJSON(self.options, self.data)
 
@@ -100,7 +164,11 @@ class Wig(object):
 
 	def scan_site(self):
 		self.data['results'].printer = self.data['printer']
-		self.data['requester'] = Requester(self.options, self.data)
+		self.data['requester'] = self.create_requester()
+
+		# the resolver is shared by all the sites, so only the
+		# lookups made after this are reported for the site
+		self.data['dns_stats'] = self.data['resolver'].get_stats()
 
 		#
 		# --- DETECT REDIRECTION ----------------
@@ -116,6 +184,7 @@ class Wig(object):
 			if self.options['write_file'] is not None:
 				self.json_outputter.add_error(str(err))
 
+			self.data['requester'].close()
 			return
 
 		if is_redirected:
@@ -160,7 +229,7 @@ class Wig(object):
 
 		# get the IP of the domain
 		# issue 19: changed DiscoverIP to return a list of IPs
-		self.data['results'].site_info['ip'] = DiscoverIP(self.options['url']).run()
+		self.data['results'].site_info['ip'] = DiscoverIP(self.options['url'], self.data['resolver']).run()
 
 
 		#
@@ -176,17 +245,25 @@ class Wig(object):
 		#
 		# --- VERSION DETECTION -----------------
 		#
-		# Search for the first CMS
-		DiscoverCMS(self.options, self.data).run()
-
-		# find Platform
-		DiscoverPlatform(self.options, self.data).run()
+		# Search for the first CMS, the platform and interesting files.
+		# These do not depend on each other, so they run at the same
+		# time and share the requester
+		platform = DiscoverPlatform(self.options, self.data)
+		interesting = DiscoverInteresting(self.options, self.data)
+		self.run_concurrently(
+			DiscoverCMS(self.options, self.data).run,
+			platform.probe,
+			interesting.probe
+		)
+
+		# search the responses of all three for platform
+		# information and interesting files
+		platform.search_cache()
+		interesting.search_cache()
 
 		#
 		# --- GET MORE DATA FROM THE SITE -------
 		#
-		# find interesting files
-		DiscoverInteresting(self.options, self.data).run()
 
 		# find and request links to static files on the pages
 		DiscoverMore(self.options, self.data).run()
@@ -237,6 +314,25 @@ class Wig(object):
 		# search the vulnerability fingerprints for matches
 		DiscoverVulnerabilities(self.data).run()
 
+		# close the connections kept alive by the requester
+		self.data['requester'].close()
+		pool_stats = self.data['requester'].pool.get_stats()
+		self.data['printer'].print_debug_line('Connections reused: %(hits)s, opened: %(misses)s' % pool_stats, 1)
+
+		dns_stats = self.data['resolver'].get_stats(self.data['dns_stats'])
+		self.data['printer'].print_debug_line('DNS lookups: %(misses)s, cached: %(hits)s' % dns_stats, 1)
+
+		request_stats = self.data['requester'].controller.get_stats()
+		request_stats.update(request_stats.pop('latency'))
+		msg = 'Requests: %(requests)s (%(requests_per_second)s/s), concurrency limit: %(limit)s, latency p50/p90/p99: %(p50)s/%(p90)s/%(p99)s'
+		self.data['printer'].print_debug_line(msg % request_stats, 1)
+
+		head_stats = self.data['requester'].head_policy.get_stats()
+		msg = 'HEAD requests: %(head_requests)s, found: %(found)s, mismatches: %(mismatches)s, in use: %(use_head)s'
+		if head_stats['reason']:
+			msg += ' (stopped: %(reason)s)'
+		self.data['printer'].print_debug_line(msg % head_stats, 1)
+
 		#
 		# --- SAVE THE CACHE --------------------
 		#
@@ -260,20 +356,94 @@ class Wig(object):
 		outputter.print_results()
 
 
+	def run_concurrently(self, *phases):
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(phases)) as executor:
+			futures = [executor.submit(phase) for phase in phases]
+
+		# raise the exceptions of the phases, if any
+		for future in futures:
+			future.result()
+
+
+	def create_requester(self):
+		if self.options['engine'] == 'async':
+			if self.options['proxy'] is None:
+				return AsyncRequester(self.options, self.data)
+
+			self.data['printer'].print_debug_line('The async engine does not support proxies - using threads', 1)
+
+		return Requester(self.options, self.data)
+
+
 	def get_results(self):
 		return self.data['results'].results
 
 
+	def create_cache(self):
+		cache = Cache()
+		cache.set_location(self.options['cache_dir'])
+		cache.printer = self.data['printer']
+		return cache
+
+
 	def reset(self):
+		# each site gets its own results, cache and requester
 		self.data['results'] = Results(self.options)
-		self.data['cache'] = Cache()
+		self.data['cache'] = self.create_cache()
+		self.data['requested'] = queue.Queue()
+
+
+	def _add_worker_result(self, result):
+		if isinstance(result, Exception):
+			self.data['printer'].print_debug_line('Error in worker: %s' % (result, ), 0)
+			return
+
+		output, sites = result
+		print(output, end='')
+		for site in sites:
+			self.json_outputter.add_site(site)
+
+
+	def run_parallel(self):
+		"""
+		Scan the sites in worker processes. Each worker scans one site
+		at a time, and the results are written as soon as a site is
+		done. The urls are read as the sites are scanned, with at most
+		two sites per worker waiting, and nothing is kept for the
+		finished sites, so the memory usage does not depend on the
+		number of sites.
+		"""
+		workers = multiprocessing.Pool(self.options['workers'], initializer=_init_worker, initargs=(self.args, ))
+		window = self.options['workers'] * 2
+
+		done = queue.Queue()
+		num_pending = 0
+		try:
+			for url in self.options['urls']:
+				workers.apply_async(_scan_worker, (url, ), callback=done.put, error_callback=done.put)
+				num_pending += 1
+
+				if num_pending >= window:
+					self._add_worker_result(done.get())
+					num_pending -= 1
+
+			while num_pending > 0:
+				self._add_worker_result(done.get())
+				num_pending -= 1
+		finally:
+			workers.terminate()
+			workers.join()
+
 
 	def run(self):
 		if self.options['urls'] is not None:
-			for url in self.options['urls']:
-				self.reset()
-				self.options['url'] = url.strip()
-				self.scan_site()
+			if self.options['workers'] > 1:
+				self.run_parallel()
+			else:
+				for url in self.options['urls']:
+					self.reset()
+					self.options['url'] = url
+					self.scan_site()
 		else:
 			self.scan_site()
 
@@ -302,6 +472,12 @@ def parse_args(url=None):
 	parser.add_argument('-m', action='store_true', dest='match_all', default=False,
 		help='Try harder to find a match without making more requests')
 
+	parser.add_argument('--adaptive_version', action='store_true', default=False,
+		help='Only request the urls needed to determine the version of a detected CMS')
+
+	parser.add_argument('--version_confidence', type=float, default=0.9,
+		help='Stop the adaptive version search when a version has this share of the score. Default: 0.9')
+
 	parser.add_argument('-u', action='store_true', dest='user_agent',
 		default='Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2049.0 Safari/537.36',
 		help='User-agent to use in the requests')
@@ -312,6 +488,33 @@ def parse_args(url=None):
 	parser.add_argument('-t', dest='threads', default=10, type=int,
 		help='Number of threads to use')
 
+	parser.add_argument('--rate', dest='rate', default=0, type=float,
+		help='Max number of requests per second to a host. Default: no limit')
+
+	parser.add_argument('--connect_timeout', dest='connect_timeout', default=10, type=float,
+		help='Seconds to wait for a connection to the host. Default: 10')
+
+	parser.add_argument('--read_timeout', dest='read_timeout', default=20, type=float,
+		help='Seconds to wait for a response from the host. Default: 20')
+
+	parser.add_argument('--retries', dest='retries', default=2, type=int,
+		help='Number of times to retry a request after a timeout or a dropped connection. Default: 2')
+
+	parser.add_argument('--max_body', dest='max_body', default=None, type=float,
+		help='Maximum size of a response body in MB. Larger bodies are cut off. Default: no limit')
+
+	parser.add_argument('--early_stop', dest='early_stop', action='store_true', default=False,
+		help='Stop reading a response once all the strings it is searched for have been found')
+
+	parser.add_argument('--engine', dest='engine', default='threads', choices=['threads', 'async'],
+		help='Request engine to use. Default: threads')
+
+	parser.add_argument('--concurrency', dest='concurrency', default=100, type=int,
+		help='Max number of concurrent requests for the async engine. Default: 100')
+
+	parser.add_argument('--host_connections', dest='host_connections', default=10, type=int,
+		help='Max number of connections per host for the async engine. Default: 10')
+
 	parser.add_argument('--no_cache_load', action='store_true', default=False,
 		help='Do not load cached responses')
 
@@ -333,11 +536,23 @@ def parse_args(url=None):
 	parser.add_argument('-w', dest='output_file', default=None,
 		help='File to dump results into (JSON)')
 
+	parser.add_argument('--jsonl', action='store_true', dest='json_lines', default=False,
+		help='Write the results as JSON Lines, one line per site as soon as it has been scanned')
+
+	parser.add_argument('--workers', dest='workers', default=1, type=int,
+		help='Number of sites from the url file (-l) to scan in parallel. Implies --jsonl. Default: 1')
+
+	parser.add_argument('--build_db', action='store_true', default=False,
+		help='Compile the fingerprints into a database for faster startup and exit')
+
 	args = parser.parse_args()
 
 	if url is not None:
 		args.url = url
 
+	if args.build_db:
+		return args
+
 	if args.input_file is None and args.url is None:
 		raise Exception('No target(s) specified')
 
@@ -348,6 +563,15 @@ def parse_args(url=None):
 	return args
 
 
+def build_database():
+	"""
+		Compile the JSON fingerprints into a database, which is
+		loaded instead of the JSON files as long as it is up to date.
+	"""
+	database = Fingerprints().compile_database()
+	print('Fingerprint database written to: %s' % (database, ))
+
+
 def wig(**kwargs):
 	"""
 		Use this to call wig from python: